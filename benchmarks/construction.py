@@ -0,0 +1,90 @@
+"""
+Benchmark of the validated and the trusted construction of SRI
+
+    python benchmarks/construction.py
+"""
+
+import os
+import sys
+import timeit
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sri import SRI  # noqa: E402
+
+
+def get_data(lines):
+    return {
+        "emission_date": date.today(),
+        "document_type": "01",
+        "environment": "1",
+        "company_ruc": "0100067500001",
+        "billing_name": "Rush Soft",
+        "company_name": "Rush Delivery",
+        "company_address": "Manuel Moreno y Canaverales",
+        "main_address": "Manuel Moreno y Canaverales",
+        "numeric_code": "00000001",
+        "company_obligado_contabilidad": "SI",
+        "establishment": "001",
+        "point_emission": "001",
+        "emission_type": "1",
+        "sequential": "000000005",
+        "customer_billing_name": "Jhon Doe",
+        "customer_identification": "1792146739001",
+        "customer_identification_type": "04",
+        "customer_address": "Av. 6 de Diciembre y Av. 10 de Agosto",
+        "lines_items": [
+            {
+                "code": str(i).zfill(4),
+                "aux_code": "ABC-{}".format(i),
+                "description": "Producto {}".format(i),
+                "quantity": 1,
+                "unit_price": 100,
+                "discount": 0,
+                "price_total_without_tax": 100,
+                "total_price": 112,
+                "taxes": [
+                    {
+                        "code": "2",
+                        "tax_percentage_code": "2",
+                        "base": 100,
+                        "additional_discount": 0,
+                        "value": 12,
+                    },
+                ],
+            }
+            for i in range(lines)
+        ],
+        "payments": [
+            {
+                "payment_method": "01",
+                "total": 112 * lines,
+                "terms": 0,
+                "unit_time": "dias",
+            }
+        ],
+        "tips": 0,
+    }
+
+
+def main():
+    for lines in (1, 10, 100):
+        data = get_data(lines)
+        number = 20000 // lines
+
+        validated = timeit.timeit(lambda: SRI(**data), number=number)
+        trusted = timeit.timeit(lambda: SRI.from_trusted(**data), number=number)
+
+        print(
+            "{:>4} lines: SRI() {:8.1f} us  SRI.from_trusted() {:8.1f} us  x{:.1f}".format(
+                lines,
+                validated / number * 1e6,
+                trusted / number * 1e6,
+                validated / trusted,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,4 +8,10 @@ setup(
         # 'zeep',
         # 'signxml',
     ],
+    entry_points={
+        'console_scripts': [
+            'sri=sri.cli:main',
+            'sri-signd=sri.daemon:main',
+        ],
+    },
 )
\ No newline at end of file
@@ -6,19 +6,14 @@
 import base64
 import os
 from datetime import date, datetime
+from functools import lru_cache
 from io import BytesIO
 
 import zeep
-from OpenSSL import crypto
 from barcode import Code39
 from barcode.writer import SVGWriter
 from jinja2 import Environment, select_autoescape, FileSystemLoader
-from lxml import etree
-from pydantic import BaseModel, constr, ValidationError, validator
-from signxml import DigestAlgorithm
-from signxml.xades import (
-    XAdESDataObjectFormat,
-)
+from pydantic import BaseModel, constr, ValidationError, root_validator, validator
 from typing import List, Optional
 
 try:
@@ -28,7 +23,12 @@ except ImportError:
 
 from weasyprint import HTML
 
-from .XAdESSigner import MyXAdESSigner
+from . import metrics
+from .cache import CachedResult, ResultCache, get_xml_digest
+from .documents import get_title, render_xml
+from .signing import Certificate, load_certificate, sign_xml
+from .traffic import get_traffic_controller
+from .xsd import has_schema, validate_xml
 from .enum import (
     EnvironmentEnum,
     DocumentTypeEnum,
@@ -38,8 +38,12 @@ from .enum import (
     UnitTimeEnum,
     PaymentMethodEnum,
     IdentificationTypeEnum,
+    InvoiceStateEnum,
 )
 
+# Error returned by the SRI when the access key was already received
+ACCESS_KEY_REGISTERED = "43"
+
 loader = FileSystemLoader(
     [os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")]
 )
@@ -47,6 +51,85 @@ loader = FileSystemLoader(
 loader = Environment(loader=loader, autoescape=select_autoescape())
 
 
+@lru_cache(maxsize=None)
+def get_client(wsdl: str):
+    """
+    Function to get a SOAP client, the wsdl is fetched once per process
+    """
+    return zeep.Client(wsdl=wsdl)
+
+
+def is_access_key_registered(response) -> bool:
+    """
+    Function to check if a reception was returned because the access key was
+    already registered in the SRI
+    """
+    if response["estado"] != "DEVUELTA" or not response["comprobantes"]:
+        return False
+
+    for comprobante in response["comprobantes"]["comprobante"]:
+        if not comprobante["mensajes"]:
+            continue
+
+        for mensaje in comprobante["mensajes"]["mensaje"]:
+            if str(mensaje["identificador"]) == ACCESS_KEY_REGISTERED:
+                return True
+
+    return False
+
+
+def get_authorization_state(response) -> InvoiceStateEnum:
+    """
+    Function to get the state of an authorization response, a response without
+    authorizations means the SRI is still processing the invoice
+    """
+    if not response or not response["autorizaciones"]:
+        return InvoiceStateEnum.PROCESSING
+
+    authorizations = response["autorizaciones"]["autorizacion"]
+
+    if not authorizations:
+        return InvoiceStateEnum.PROCESSING
+
+    try:
+        return InvoiceStateEnum(authorizations[0]["estado"])
+    except ValueError:
+        return InvoiceStateEnum.PROCESSING
+
+
+def get_authorization_date(response) -> datetime:
+    """
+    Function to get the authorization date of an authorized invoice
+    """
+    value = response["autorizaciones"]["autorizacion"][0]["fechaAutorizacion"]
+
+    if isinstance(value, datetime):
+        return value
+
+    return datetime.fromisoformat(str(value))
+
+
+def _construct(model, values: dict):
+    """
+    Create a model without validation, like BaseModel.construct but without
+    copying the defaults, every default of these models is immutable
+    """
+    instance = model.__new__(model)
+    object.__setattr__(instance, "__dict__", values)
+    object.__setattr__(instance, "__fields_set__", set(values))
+    return instance
+
+
+# Enum fields of SRI converted by SRI.from_trusted
+_TRUSTED_ENUMS = {
+    "environment": EnvironmentEnum,
+    "document_type": DocumentTypeEnum,
+    "modified_document_type": DocumentTypeEnum,
+    "emission_type": EmmisionTypeEnum,
+    "customer_identification_type": IdentificationTypeEnum,
+}
+
+
 class TaxItem(BaseModel):
     """
     Class for handling tax items
@@ -58,6 +141,24 @@ class TaxItem(BaseModel):
     base: float
     value: float
 
+    @classmethod
+    def from_trusted(cls, **data) -> "TaxItem":
+        """
+        Create a tax item from trusted data without validation
+        """
+        return _construct(
+            cls,
+            {
+                "code": TaxCodeEnum(data["code"]),
+                "tax_percentage_code": PercentageTaxCodeEnum(
+                    data["tax_percentage_code"]
+                ),
+                "additional_discount": float(data["additional_discount"]),
+                "base": float(data["base"]),
+                "value": float(data["value"]),
+            },
+        )
+
     @property
     def tarifa(self):
         if self.tax_percentage_code == PercentageTaxCodeEnum.ZERO:
@@ -88,6 +189,21 @@ class PaymentItem(BaseModel):
     terms: int
     unit_time: UnitTimeEnum
 
+    @classmethod
+    def from_trusted(cls, **data) -> "PaymentItem":
+        """
+        Create a payment item from trusted data without validation
+        """
+        return _construct(
+            cls,
+            {
+                "payment_method": PaymentMethodEnum(data["payment_method"]),
+                "total": float(data["total"]),
+                "terms": int(data["terms"]),
+                "unit_time": UnitTimeEnum(data["unit_time"]),
+            },
+        )
+
 
 class LineItem(BaseModel):
     """
@@ -104,6 +220,29 @@ class LineItem(BaseModel):
     taxes: List[TaxItem]
     total_price: float
 
+    @classmethod
+    def from_trusted(cls, **data) -> "LineItem":
+        """
+        Create a line item from trusted data without validation
+        """
+        return _construct(
+            cls,
+            {
+                "code": data["code"],
+                "aux_code": data["aux_code"],
+                "description": data["description"],
+                "quantity": int(data["quantity"]),
+                "unit_price": float(data["unit_price"]),
+                "discount": float(data["discount"]),
+                "price_total_without_tax": float(data["price_total_without_tax"]),
+                "taxes": [
+                    t if isinstance(t, TaxItem) else TaxItem.from_trusted(**t)
+                    for t in data["taxes"]
+                ],
+                "total_price": float(data["total_price"]),
+            },
+        )
+
 
 class SRI(BaseModel):
     """
@@ -141,9 +280,91 @@ class SRI(BaseModel):
     lines_items: List[LineItem]
     tips: float
 
+    # Comprobante modified by a credit or debit note
+    modified_document_type: Optional[DocumentTypeEnum] = None
+    modified_document_number: Optional[
+        constr(regex=r"^[0-9]{3}-[0-9]{3}-[0-9]{9}$")
+    ] = None  # e.g. 001-001-000000001
+    modified_document_date: Optional[date] = None
+    reason: Optional[constr(min_length=1, max_length=300)] = None
+
     def __init__(self, **data):
         super().__init__(**data)
 
+    @root_validator(skip_on_failure=True)
+    def check_modified_document(cls, values):
+        """
+        Credit and debit notes must reference the comprobante they modify
+        """
+        document_type = values.get("document_type")
+
+        if document_type in (
+            DocumentTypeEnum.NOTA_CREDITO,
+            DocumentTypeEnum.NOTA_DEBITO,
+        ):
+            required = [
+                "modified_document_type",
+                "modified_document_number",
+                "modified_document_date",
+            ]
+
+            if document_type == DocumentTypeEnum.NOTA_CREDITO:
+                required.append("reason")
+
+            missing = [name for name in required if values.get(name) is None]
+
+            if missing:
+                raise ValueError(
+                    "{} required for the document type {}".format(
+                        ", ".join(missing), document_type.value
+                    )
+                )
+
+        return values
+
+    @classmethod
+    def from_trusted(cls, **data) -> "SRI":
+        """
+        Create an invoice from trusted data, e.g. an already validated ledger.
+
+        The length and format checks are skipped, only the enums, dates and
+        numbers are converted so the invoice renders exactly as a validated one.
+        Unknown keys are ignored like in the validated constructor.
+        """
+        values = {
+            name: data[name] if name in data else field.default
+            for name, field in cls.__fields__.items()
+        }
+
+        for name, enum in _TRUSTED_ENUMS.items():
+            if values.get(name) is not None:
+                values[name] = enum(values[name])
+
+        for name in ("emission_date", "modified_document_date"):
+            if isinstance(values[name], str):
+                values[name] = date.fromisoformat(values[name])
+
+        values["tips"] = float(values["tips"])
+        values["payments"] = [
+            p if isinstance(p, PaymentItem) else PaymentItem.from_trusted(**p)
+            for p in values["payments"]
+        ]
+        values["lines_items"] = [
+            i if isinstance(i, LineItem) else LineItem.from_trusted(**i)
+            for i in values["lines_items"]
+        ]
+
+        return _construct(cls, values)
+
+    @classmethod
+    def from_xml(cls, xml, validate: bool = False) -> "SRI":
+        """
+        Create an invoice from the xml of an authorized comprobante
+        """
+        from .parser import invoice_from_xml
+
+        return invoice_from_xml(xml, validate=validate)
+
     def __get_reception_url(self):
         """
         Function to get the url of receipt of invoices
@@ -224,88 +445,147 @@ class SRI(BaseModel):
 
     def get_xml(self):
         """
-        Function to get the xml of the electronic invoice
+        Function to get the xml of the electronic comprobante, the template is
+        chosen by its document_type
         """
-        access_key = self.get_access_key()
+        return render_xml(self)
 
-        render = loader.get_template("factura_V1.1.0.xml").render(
-            {
-                "bill": self,
-                "claveAcceso": access_key,
-                "fechaEmision": self.emission_date.strftime("%d/%m/%Y"),
-            }
-        )
+    def write_xml(self, sink, lines=None):
+        """
+        Function to stream the xml of the electronic invoice to a file path or
+        a binary file, lines is a function returning the line items to use
+        instead of lines_items, see sri.writer.write_xml
+        """
+        from .writer import write_xml
 
-        return render.replace("\n", "")
+        write_xml(self, sink, lines=lines)
 
-    def get_xml_signed(self, certificate_file_path: str, password: str):
+    def get_xml_signed(
+        self,
+        certificate_file_path: str = None,
+        password: str = None,
+        certificate: Certificate = None,
+    ):
         """
         Function to sign the electronic invoice
         """
+        if certificate is None:
+            certificate = load_certificate(certificate_file_path, password)
 
-        p12 = crypto.load_pkcs12(
-            open(certificate_file_path, "rb").read(), password.encode("utf-8")
-        )
+        with metrics.measure(metrics.SIGN_SECONDS, "sign"):
+            return sign_xml(self.get_xml(), certificate)
 
-        # PEM formatted private key
-        key = crypto.dump_privatekey(crypto.FILETYPE_PEM, p12.get_privatekey())
+    def validate_xsd(self):
+        """
+        Function to validate the electronic invoice against the SRI schema
+        """
+        return validate_xml(self.get_xml(), self.document_type)
 
-        # PEM formatted certificate
-        cert = crypto.dump_certificate(crypto.FILETYPE_PEM, p12.get_certificate())
+    def validate_sri(
+        self,
+        certificate_file_path: str,
+        password: str,
+        cache: ResultCache = None,
+        validate_schema: bool = False,
+    ):
+        """
+        Function to validate the electronic invoice in the SRI, with
+        validate_schema an invoice that does not match the schema is rejected
+        locally and the errors are returned instead of the SRI response
+        """
+        # Document types without a local schema are only validated by the SRI
+        if validate_schema and has_schema(self.document_type):
+            is_valid, errors = self.validate_xsd()
 
-        data_object_format = XAdESDataObjectFormat(
-            Description="contenido comprobante",
-            MimeType="text/xml",
-        )
-        signer = MyXAdESSigner(
-            data_object_format=data_object_format,
-            c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315",
-            signature_algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1",
-            digest_algorithm=DigestAlgorithm.SHA1,
-        )
+            if not is_valid:
+                return False, errors
 
-        doc = self.get_xml().encode("utf-8")
+        xml = xml_digest = None
 
-        data = etree.fromstring(doc)
+        if cache is not None:
+            # A corrected invoice keeps its access key, it is signed again
+            xml_digest = get_xml_digest(self.get_xml())
+            cached = cache.get(self.get_access_key())
 
-        signed_doc = signer.sign(
-            data,
-            key=key,
-            cert=cert,
-            reference_uri=["#comprobante"],
-        )
+            if cached is not None:
+                xml = cached.get_xml_signed(xml_digest)
 
-        return etree.tostring(
-            signed_doc, pretty_print=True, encoding="unicode", method="xml"
-        )
+        if xml is None:
+            xml = self.get_xml_signed(
+                certificate_file_path=certificate_file_path, password=password
+            )
+
+            if cache is not None:
+                cache.set_signed(self.get_access_key(), xml, xml_digest)
 
-    def validate_sri(self, certificate_file_path: str, password: str):
+        return self.validate_xml_signed(xml, cache=cache, xml_digest=xml_digest)
+
+    def validate_xml_signed(
+        self, xml_signed: str, cache: ResultCache = None, xml_digest: str = None
+    ):
         """
-        Function to validate the electronic invoice in the SRI
+        Function to send an already signed electronic invoice to the SRI, an
+        access key already registered means a previous attempt was received
         """
+        cached = None
+
+        if cache is not None:
+            if xml_digest is None:
+                xml_digest = get_xml_digest(self.get_xml())
+
+            cached = cache.get(self.get_access_key())
+
+        if cached is not None and cached.get_reception(xml_digest) is not None:
+            return True, cached.reception
+
+        client = get_client(self.__get_reception_url())
 
-        client = zeep.Client(wsdl=self.__get_reception_url())
         # transform the xml to bytes
-        xml = self.get_xml_signed(
-            certificate_file_path=certificate_file_path, password=password
-        ).encode("utf-8")
+        with get_traffic_controller(self.environment).request():
+            with metrics.measure(metrics.RECEPTION_SECONDS, "reception") as labels:
+                response = client.service.validarComprobante(xml_signed.encode("utf-8"))
+                labels["state"] = response["estado"]
+
+        is_valid = response["estado"] == "RECIBIDA" or is_access_key_registered(
+            response
+        )
 
-        response = client.service.validarComprobante(xml)
+        if is_valid:
+            metrics.set_pending(self.get_access_key(), True)
 
-        is_valid = response["estado"] == "RECIBIDA"
+        if cache is not None:
+            if is_valid:
+                cache.set_reception(self.get_access_key(), response, xml_digest)
+            else:
+                # Returned for its content, the corrected invoice is signed again
+                cache.discard(self.get_access_key(), *CachedResult._fields)
 
         return is_valid, response
 
-    def get_authorization(self):
+    def get_authorization(self, cache: ResultCache = None):
         """
         Function to get the authorization of the electronic invoice in the SRI
         """
+        access_key = self.get_access_key()
 
-        client = zeep.Client(wsdl=self.__get_authorization_url())
+        cached = cache.get(access_key) if cache is not None else None
 
-        access_key = self.get_access_key()
+        if cached is not None and cached.authorization is not None:
+            return (
+                get_authorization_state(cached.authorization)
+                == InvoiceStateEnum.AUTHORIZED,
+                cached.authorization,
+            )
+
+        client = get_client(self.__get_authorization_url())
 
-        response = client.service.autorizacionComprobante(access_key)
+        with get_traffic_controller(self.environment).request():
+            with metrics.measure(
+                metrics.AUTHORIZATION_SECONDS, "authorization"
+            ) as labels:
+                response = client.service.autorizacionComprobante(access_key)
+                state = get_authorization_state(response)
+                labels["state"] = state.value
 
         authorized = (
             response["autorizaciones"]["autorizacion"][0]["estado"] == "AUTORIZADO"
@@ -313,6 +593,17 @@ class SRI(BaseModel):
             else False
         )
 
+        if state in (InvoiceStateEnum.AUTHORIZED, InvoiceStateEnum.NOT_AUTHORIZED):
+            metrics.set_pending(access_key, False)
+
+            # Only final states are cached, a pending authorization is asked again
+            if cache is not None:
+                cache.set(access_key, authorization=response)
+
+                # A not authorized invoice has to be sent again
+                if state == InvoiceStateEnum.NOT_AUTHORIZED:
+                    cache.discard(access_key, "reception")
+
         return authorized, response
 
     @staticmethod
@@ -354,6 +645,7 @@ class SRI(BaseModel):
         html = loader.get_template("ride.html").render(
             {
                 "bill": self,
+                "document_title": get_title(self.document_type),
                 "authorization_date": authorization_date.strftime("%Y-%m-%d %H:%M:%S"),
                 "logo_base64": self.get_logo_base64(logo_file_path),
                 # "barcode_image": self.get_barcode_image(),
@@ -365,7 +657,8 @@ class SRI(BaseModel):
         #  bytes-like object
         file = BytesIO()
 
-        HTML(string=html).write_pdf(file)
+        with metrics.measure(metrics.PDF_SECONDS, "pdf"):
+            HTML(string=html).write_pdf(file)
 
         return file.getbuffer()
 
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming bulk signing of invoices exported as JSONL or CSV
+
+Rows are read lazily, grouped into invoices and signed on a process pool with
+a bounded number of invoices in flight, the signed xml is written to the sink
+as soon as it is ready, so memory does not grow with the size of the input.
+
+JSONL files hold an invoice per line with the same fields as SRI, or one line
+item per line like the CSV files. CSV files hold one line item per row, the
+invoice columns use the SRI field names and repeat on every row, the line
+item, tax and payment columns are prefixed with "line.", "tax." and
+"payment.". Consecutive rows with the same RUC, establishment, point of
+emission and sequential belong to the same invoice.
+
+A row continues the line item of the previous row, adding a tax to it, when
+they have the same "line.index", or without that column when every "line."
+cell is equal. Payments are told apart by "payment.index", without that
+column identical payments are taken as the same payment repeated on each row.
+"""
+
+import csv
+import json
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from .signing import Certificate
+
+INVOICE_KEY = ("company_ruc", "establishment", "point_emission", "sequential")
+
+LINE_PREFIX = "line."
+TAX_PREFIX = "tax."
+PAYMENT_PREFIX = "payment."
+
+# Identifier columns of the line items and payments of an invoice
+INDEX = "index"
+
+# Certificate loaded once per worker process
+_certificate = None
+
+
+class BulkResult(NamedTuple):
+    """
+    Result of an invoice signed in bulk
+    """
+
+    index: int
+    access_key: Optional[str]
+    error: Optional[str] = None
+
+
+def read_jsonl(path: str) -> Iterator[dict]:
+    """
+    Function to read the rows of a JSONL file lazily
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv(path: str, delimiter: str = ",") -> Iterator[dict]:
+    """
+    Function to read the rows of a CSV file lazily, empty cells are ignored
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f, delimiter=delimiter):
+            yield {k: v for k, v in row.items() if v not in (None, "")}
+
+
+def read_rows(path: str) -> Iterator[dict]:
+    """
+    Function to read the rows of a file according to its extension
+    """
+    if path.endswith(".csv"):
+        return read_csv(path)
+
+    return read_jsonl(path)
+
+
+def read_invoices(paths: Iterable[str]) -> Iterator[dict]:
+    """
+    Function to read the invoices of JSON, JSONL and CSV files, directories
+    are read in name order
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from read_invoices(
+                sorted(
+                    os.path.join(path, name)
+                    for name in os.listdir(path)
+                    if name.endswith((".json", ".jsonl", ".csv"))
+                )
+            )
+        elif path.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as f:
+                yield json.load(f)
+        else:
+            yield from group_rows(read_rows(path))
+
+
+def _pick(row: dict, prefix: str) -> dict:
+    return {k[len(prefix) :]: v for k, v in row.items() if k.startswith(prefix)}
+
+
+def group_rows(rows: Iterable[dict]) -> Iterator[dict]:
+    """
+    Function to group consecutive line item rows into invoices, rows that
+    already are an invoice are returned as they are
+    """
+    invoice = None
+    key = None
+    last_line = None
+    payments = set()
+
+    for row in rows:
+        if "lines_items" in row:
+            if invoice is not None:
+                yield invoice
+                invoice = key = None
+
+            yield row
+            continue
+
+        row_key = tuple(row.get(name) for name in INVOICE_KEY)
+
+        if row_key != key:
+            if invoice is not None:
+                yield invoice
+
+            key = row_key
+            invoice = {
+                k: v
+                for k, v in row.items()
+                if not k.startswith((LINE_PREFIX, TAX_PREFIX, PAYMENT_PREFIX))
+            }
+            invoice["lines_items"] = []
+            invoice["payments"] = []
+            invoice.setdefault("tips", 0)
+            last_line = None
+            payments = set()
+
+        line = _pick(row, LINE_PREFIX)
+        tax = _pick(row, TAX_PREFIX)
+        payment = _pick(row, PAYMENT_PREFIX)
+
+        lines = invoice["lines_items"]
+
+        if line and line != last_line:
+            last_line = line
+            line = {k: v for k, v in line.items() if k != INDEX}
+            line["taxes"] = []
+            lines.append(line)
+
+        if tax and lines:
+            lines[-1]["taxes"].append(tax)
+
+        if payment:
+            if INDEX in payment:
+                payment_key = payment.pop(INDEX)
+            else:
+                payment_key = tuple(sorted(payment.items()))
+
+            if payment_key not in payments:
+                payments.add(payment_key)
+                invoice["payments"].append(payment)
+
+    if invoice is not None:
+        yield invoice
+
+
+class DirectorySink:
+    """
+    Class for writing signed invoices to a directory, one file per access key
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, access_key: str, xml_signed: str):
+        name = os.path.join(self.path, "{}.xml".format(access_key))
+
+        with open(name, "w", encoding="utf-8") as f:
+            f.write(xml_signed)
+
+    def close(self):
+        pass
+
+
+class ZipSink:
+    """
+    Class for writing signed invoices to a ZIP archive as they are signed
+    """
+
+    def __init__(self, path: str, compression: int = zipfile.ZIP_DEFLATED):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, mode="w", compression=compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, access_key: str, xml_signed: str):
+        self._zip.writestr("{}.xml".format(access_key), xml_signed)
+
+    def close(self):
+        self._zip.close()
+
+
+def _init_worker(certificate: Certificate):
+    global _certificate
+    _certificate = certificate
+
+
+def _sign(invoice: dict, trusted: bool):
+    from . import SRI
+
+    try:
+        if trusted:
+            bill = SRI.from_trusted(**invoice)
+        else:
+            bill = SRI(**invoice)
+
+        return (
+            bill.get_access_key(),
+            bill.get_xml_signed(certificate=_certificate),
+            None,
+        )
+    except Exception as e:
+        return None, None, "{}: {}".format(type(e).__name__, e)
+
+
+def sign_invoices(
+    invoices: Iterable[dict],
+    sink,
+    certificate: Certificate,
+    workers: int = None,
+    window: int = None,
+    trusted: bool = False,
+) -> Iterator[BulkResult]:
+    """
+    Function to sign invoices in parallel and write them to the sink
+
+    At most window invoices are in flight, results are returned in the input
+    order as they are written.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 4
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(certificate,)
+    ) as executor:
+        pending = deque()
+
+        def done():
+            index, future = pending.popleft()
+            access_key, xml_signed, error = future.result()
+
+            if error is None:
+                sink.write(access_key, xml_signed)
+
+            return BulkResult(index=index, access_key=access_key, error=error)
+
+        for index, invoice in enumerate(invoices):
+            pending.append((index, executor.submit(_sign, invoice, trusted)))
+
+            if len(pending) >= window:
+                yield done()
+
+        while pending:
+            yield done()
+
+
+def open_sink(path: str):
+    """
+    Function to open a ZIP sink for .zip paths, a directory sink otherwise
+    """
+    if path.endswith(".zip"):
+        return ZipSink(path)
+
+    return DirectorySink(path)
+
+
+def sign_file(
+    input_path: str, output_path: str, certificate: Certificate, **kwargs
+) -> Iterator[BulkResult]:
+    """
+    Function to sign every invoice of a JSONL or CSV file into a directory or
+    a ZIP archive
+    """
+    with open_sink(output_path) as sink:
+        yield from sign_invoices(
+            group_rows(read_rows(input_path)), sink, certificate, **kwargs
+        )
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of signed documents and SRI results keyed by access key
+
+A retry of an invoice that was already signed reuses the signed xml while the
+rendered document is unchanged, an invoice already received is not sent again
+while it is unchanged and an authorization that reached a final state is not
+requested again. A corrected invoice keeps its access key, so signing it again
+or a NO AUTORIZADO drops the responses cached for the previous document.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+
+from .outbox import serialize_response
+
+
+class CachedResult(NamedTuple):
+    """
+    Cached signed xml and SRI responses of an invoice
+    """
+
+    xml_signed: Optional[str] = None
+    reception: Any = None
+    authorization: Any = None
+    # Digest of the unsigned xml that was signed
+    xml_digest: Optional[str] = None
+
+    def get_xml_signed(self, xml_digest: str) -> Optional[str]:
+        """
+        Return the signed xml if it was signed from the same document
+        """
+        if self.xml_signed is not None and self.xml_digest == xml_digest:
+            return self.xml_signed
+
+        return None
+
+    def get_reception(self, xml_digest: str) -> Any:
+        """
+        Return the reception if it was for the same document
+        """
+        if self.reception is not None and self.xml_digest == xml_digest:
+            return self.reception
+
+        return None
+
+
+def get_xml_digest(xml: str) -> str:
+    """
+    Function to get the digest of an unsigned xml, the access key does not
+    cover the content of the invoice
+    """
+    return hashlib.sha256(xml.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Base class of the result caches
+    """
+
+    def get(self, access_key: str) -> Optional[CachedResult]:
+        raise NotImplementedError
+
+    def set(self, access_key: str, **fields):
+        """
+        Store fields of the cached result, the other fields are kept
+        """
+        raise NotImplementedError
+
+    def discard(self, access_key: str, *fields: str):
+        """
+        Remove fields of the cached result
+        """
+        raise NotImplementedError
+
+    def set_signed(self, access_key: str, xml_signed: str, xml_digest: str):
+        """
+        Store a new signature, the responses of the document signed before
+        under the same access key are dropped
+        """
+        self.discard(access_key, "reception", "authorization")
+        self.set(access_key, xml_signed=xml_signed, xml_digest=xml_digest)
+
+    def set_reception(self, access_key: str, reception, xml_digest: str):
+        """
+        Store the reception of a document, the SRI processes it again so the
+        authorization of a previous reception is dropped
+        """
+        cached = self.get(access_key)
+
+        if cached is not None and cached.xml_digest != xml_digest:
+            self.discard(access_key, "xml_signed", "authorization")
+        else:
+            self.discard(access_key, "authorization")
+
+        self.set(access_key, reception=reception, xml_digest=xml_digest)
+
+
+class MemoryCache(ResultCache):
+    """
+    In memory LRU cache
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, access_key: str) -> Optional[CachedResult]:
+        with self._lock:
+            result = self._results.get(access_key)
+
+            if result is not None:
+                self._results.move_to_end(access_key)
+
+            return result
+
+    def set(self, access_key: str, **fields):
+        with self._lock:
+            result = self._results.get(access_key, CachedResult())
+            self._results[access_key] = result._replace(**fields)
+            self._results.move_to_end(access_key)
+
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    def discard(self, access_key: str, *fields: str):
+        with self._lock:
+            result = self._results.get(access_key)
+
+            if result is not None:
+                self._results[access_key] = result._replace(
+                    **{field: None for field in fields}
+                )
+
+
+class DiskCache(ResultCache):
+    """
+    On disk cache backed by SQLite, it survives restarts and is shared by
+    every process using the same file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                access_key TEXT PRIMARY KEY,
+                xml_signed TEXT,
+                reception TEXT,
+                authorization TEXT,
+                xml_digest TEXT
+            )
+            """
+        )
+
+    def get(self, access_key: str) -> Optional[CachedResult]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT xml_signed, reception, authorization, xml_digest FROM results "
+                "WHERE access_key = ?",
+                (access_key,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return CachedResult(
+            xml_signed=row[0],
+            reception=json.loads(row[1]) if row[1] else None,
+            authorization=json.loads(row[2]) if row[2] else None,
+            xml_digest=row[3],
+        )
+
+    def set(self, access_key: str, **fields):
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO results (
+                    access_key, xml_signed, reception, authorization, xml_digest
+                )
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (access_key) DO UPDATE SET
+                    xml_signed = COALESCE(excluded.xml_signed, xml_signed),
+                    reception = COALESCE(excluded.reception, reception),
+                    authorization = COALESCE(excluded.authorization, authorization),
+                    xml_digest = COALESCE(excluded.xml_digest, xml_digest)
+                """,
+                (
+                    access_key,
+                    fields.get("xml_signed"),
+                    serialize_response(fields.get("reception")),
+                    serialize_response(fields.get("authorization")),
+                    fields.get("xml_digest"),
+                ),
+            )
+
+    def discard(self, access_key: str, *fields: str):
+        if not fields:
+            return
+
+        columns = set(CachedResult._fields)
+
+        if not columns.issuperset(fields):
+            raise ValueError("Unknown fields {}".format(set(fields) - columns))
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE results SET {} WHERE access_key = ?".format(
+                    ", ".join("{} = NULL".format(field) for field in fields)
+                ),
+                (access_key,),
+            )
+
+    def close(self):
+        self._connection.close()
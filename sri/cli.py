@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+Command line tool for emitting invoices in bulk
+
+    sri render invoices.jsonl -o xml/
+    sri sign invoices.jsonl -o signed.zip --certificate certificado.p12
+    sri submit invoices/ -o out/ --certificate certificado.p12
+    sri authorize invoices.jsonl -o out/ --certificate certificado.p12
+    sri run invoices.jsonl -o out/ --certificate certificado.p12 --outbox sri.db
+    sri pdf autorizados/ -o ride/
+
+Invoices are read from JSON files, JSONL or CSV files (see sri.bulk) or
+directories holding them. With --outbox the state of every invoice is
+recorded, running the same command again skips the finished invoices and
+resumes the others from their last state.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Iterator, List
+
+from .bulk import open_sink, read_invoices, sign_invoices
+from .enum import DocumentTypeEnum, InvoiceStateEnum
+from .outbox import PENDING_STATES, Outbox, resume_job
+from .parser import invoice_from_element, iter_comprobantes
+from .pipeline import (
+    STAGE_AUTHORIZE,
+    STAGE_PDF,
+    STAGE_VALIDATE,
+    STAGES,
+    Job,
+    Pipeline,
+    PipelineResult,
+)
+from .signing import load_certificate
+
+# States of a finished invoice that count as failed
+FAILED_STATES = (
+    InvoiceStateEnum.FAILED,
+    InvoiceStateEnum.RETURNED,
+    InvoiceStateEnum.NOT_AUTHORIZED,
+)
+
+# Last stage of the pipeline of each command
+LAST_STAGES = {
+    "submit": STAGE_VALIDATE,
+    "authorize": STAGE_AUTHORIZE,
+    "run": STAGE_PDF,
+}
+
+
+class Progress:
+    """
+    Class for reporting the progress and throughput of a command
+    """
+
+    def __init__(self, stream=sys.stderr, interval: float = 1.0, quiet: bool = False):
+        self.stream = stream
+        self.interval = interval
+        self.quiet = quiet
+
+        self.done = 0
+        self.failed = 0
+        self.states = Counter()
+        self.started = time.perf_counter()
+        self._reported_at = self.started
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.done / self.elapsed if self.elapsed else 0.0
+
+    def update(self, state: str = None, failed: bool = False, error: str = None):
+        """
+        Count a finished item
+        """
+        self.done += 1
+        self.failed += failed
+
+        if state is not None:
+            self.states[state] += 1
+
+        if error and not self.quiet:
+            self.stream.write("\n{}\n".format(error.strip()))
+
+        now = time.perf_counter()
+        if now - self._reported_at >= self.interval:
+            self._reported_at = now
+            self.report()
+
+    def report(self, end: str = ""):
+        if self.quiet:
+            return
+
+        self.stream.write(
+            "\r{} done, {} failed, {:.1f}/s{}".format(
+                self.done, self.failed, self.rate, end
+            )
+        )
+        self.stream.flush()
+
+    def close(self):
+        self.report(end="\n")
+
+
+class StageTimings:
+    """
+    Class for aggregating the time spent by the invoices in each stage
+    """
+
+    def __init__(self):
+        self.count = Counter()
+        self.total = Counter()
+        self.max = Counter()
+
+    def add(self, stage: str, elapsed: float):
+        self.count[stage] += 1
+        self.total[stage] += elapsed
+        self.max[stage] = max(self.max[stage], elapsed)
+
+    def summary(self) -> List[str]:
+        lines = [
+            "{:<10} {:>8} {:>10} {:>10} {:>10}".format(
+                "stage", "count", "total s", "mean ms", "max ms"
+            )
+        ]
+
+        for stage in STAGES:
+            count = self.count[stage]
+
+            if not count:
+                continue
+
+            lines.append(
+                "{:<10} {:>8} {:>10.2f} {:>10.1f} {:>10.1f}".format(
+                    stage,
+                    count,
+                    self.total[stage],
+                    self.total[stage] / count * 1000,
+                    self.max[stage] * 1000,
+                )
+            )
+
+        return lines
+
+
+def _error(e: Exception) -> str:
+    return "{}: {}".format(type(e).__name__, e)
+
+
+def _bills(args, progress: Progress) -> Iterator:
+    """
+    Build the invoices of the input files, invalid ones are reported
+    """
+    from . import SRI
+
+    for index, data in enumerate(read_invoices(args.inputs)):
+        try:
+            yield SRI.from_trusted(**data) if args.trusted else SRI(**data)
+        except Exception as e:
+            progress.update(
+                state=InvoiceStateEnum.FAILED.value,
+                failed=True,
+                error="Invoice {}: {}".format(index, _error(e)),
+            )
+
+
+def _certificate(args):
+    if not args.certificate or args.password is None:
+        sys.exit("sri: --certificate and --password are required")
+
+    return load_certificate(args.certificate, args.password)
+
+
+def _summary(progress: Progress, timings: StageTimings = None):
+    progress.close()
+
+    lines = [
+        "{} invoices in {:.2f}s ({:.1f}/s), {} failed".format(
+            progress.done, progress.elapsed, progress.rate, progress.failed
+        )
+    ]
+    lines.extend(
+        "  {:<14} {}".format(state, count)
+        for state, count in sorted(progress.states.items())
+    )
+
+    if timings is not None:
+        lines.extend(timings.summary())
+
+    print("\n".join(lines))
+
+    return 1 if progress.failed else 0
+
+
+def render(args) -> int:
+    """
+    Write the unsigned xml of every invoice
+    """
+    os.makedirs(args.output, exist_ok=True)
+    progress = Progress(quiet=args.quiet)
+
+    for bill in _bills(args, progress):
+        access_key = bill.get_access_key()
+        path = os.path.join(args.output, access_key + ".xml")
+
+        try:
+            # Only invoices are streamed, other comprobantes are rendered
+            if bill.document_type == DocumentTypeEnum.INVOICE:
+                bill.write_xml(path)
+            else:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(bill.get_xml())
+        except Exception as e:
+            progress.update(failed=True, error="{}: {}".format(access_key, _error(e)))
+        else:
+            progress.update()
+
+    return _summary(progress)
+
+
+def sign(args) -> int:
+    """
+    Sign every invoice into a directory or a ZIP archive
+    """
+    certificate = _certificate(args)
+    progress = Progress(quiet=args.quiet)
+
+    with open_sink(args.output) as sink:
+        for result in sign_invoices(
+            read_invoices(args.inputs),
+            sink,
+            certificate,
+            workers=args.workers,
+            trusted=args.trusted,
+        ):
+            error = result.error and "Invoice {}: {}".format(result.index, result.error)
+            progress.update(
+                state=(
+                    InvoiceStateEnum.FAILED if result.error else InvoiceStateEnum.SIGNED
+                ).value,
+                failed=result.error is not None,
+                error=error,
+            )
+
+    return _summary(progress)
+
+
+def pipeline(args) -> int:
+    """
+    Run every invoice through the pipeline up to the stage of the command
+    """
+    last_stage = LAST_STAGES[args.command]
+    certificate = _certificate(args)
+    progress = Progress(quiet=args.quiet)
+    timings = StageTimings()
+    outbox = Outbox(args.outbox) if args.outbox else None
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    def jobs() -> Iterator[Job]:
+        for bill in _bills(args, progress):
+            record = None
+
+            # The lookup does not commit the transitions buffered by the run
+            if outbox is not None:
+                record = outbox.get(bill.get_access_key(), flush=False)
+
+            if record is None:
+                yield Job(bill)
+            elif record.state in PENDING_STATES:
+                yield resume_job(record, bill)
+            else:
+                progress.update(state="SKIPPED ({})".format(record.state.value))
+
+    def on_result(result: PipelineResult):
+        if args.output:
+            path = os.path.join(args.output, result.access_key)
+
+            if result.xml_signed is not None:
+                with open(path + ".xml", "w", encoding="utf-8") as f:
+                    f.write(result.xml_signed)
+
+            if result.pdf is not None:
+                with open(path + ".pdf", "wb") as f:
+                    f.write(result.pdf)
+
+        progress.update(
+            state=result.state.value,
+            failed=result.state in FAILED_STATES,
+            error=result.error and "{}: {}".format(result.access_key, result.error),
+        )
+
+    runner = Pipeline(
+        certificate=certificate,
+        workers=args.workers,
+        concurrency=args.concurrency,
+        poll_attempts=args.poll_attempts,
+        poll_interval=args.poll_interval,
+        last_stage=last_stage,
+        logo_file_path=args.logo,
+        on_event=lambda event: timings.add(event.stage, event.elapsed),
+        on_result=on_result,
+        outbox=outbox,
+    )
+
+    try:
+        asyncio.run(runner.run_jobs(jobs()))
+    finally:
+        if outbox is not None:
+            outbox.close()
+
+    return _summary(progress, timings)
+
+
+def _authorization_date(authorization: dict) -> datetime:
+    value = authorization and authorization["fechaAutorizacion"]
+
+    if not value or authorization["estado"] != InvoiceStateEnum.AUTHORIZED.value:
+        raise ValueError("The comprobante is not authorized")
+
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%d/%m/%Y %H:%M:%S")
+
+
+def _render_pdf(bill, authorization_date: datetime, logo_file_path: str):
+    try:
+        return (
+            bill.get_access_key(),
+            bytes(bill.get_pdf(authorization_date, logo_file_path=logo_file_path)),
+            None,
+        )
+    except Exception as e:
+        return bill.get_access_key(), None, _error(e)
+
+
+def _authorized(paths: List[str]) -> Iterator:
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _authorized(
+                sorted(
+                    os.path.join(path, name)
+                    for name in os.listdir(path)
+                    if name.endswith(".xml")
+                )
+            )
+            continue
+
+        for authorization, element in iter_comprobantes(path):
+            access_key = element.findtext("infoTributaria/claveAcceso")
+
+            # A comprobante that can not be converted, e.g. a debit note
+            try:
+                bill, error = invoice_from_element(element), None
+            except ValueError as e:
+                bill, error = None, e
+
+            yield access_key, bill, authorization, error
+
+
+def pdf(args) -> int:
+    """
+    Render the RIDE of authorized comprobantes
+    """
+    os.makedirs(args.output, exist_ok=True)
+    progress = Progress(quiet=args.quiet)
+    workers = args.workers or os.cpu_count() or 1
+
+    def done(future):
+        access_key, pdf_bytes, error = future.result()
+
+        if error is None:
+            with open(os.path.join(args.output, access_key + ".pdf"), "wb") as f:
+                f.write(pdf_bytes)
+
+        progress.update(
+            state=(
+                InvoiceStateEnum.FAILED if error else InvoiceStateEnum.RENDERED
+            ).value,
+            failed=error is not None,
+            error=error and "{}: {}".format(access_key, error),
+        )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for access_key, bill, authorization, error in _authorized(args.inputs):
+            try:
+                if error is not None:
+                    raise error
+
+                authorization_date = _authorization_date(authorization)
+            except ValueError as e:
+                progress.update(
+                    state=InvoiceStateEnum.FAILED.value,
+                    failed=True,
+                    error="{}: {}".format(access_key, e),
+                )
+                continue
+
+            pending.append(
+                executor.submit(_render_pdf, bill, authorization_date, args.logo)
+            )
+
+            if len(pending) >= workers * 4:
+                done(pending.popleft())
+
+        while pending:
+            done(pending.popleft())
+
+    return _summary(progress)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Function to get the parser of the command line arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog="sri", description="Emit electronic invoices to the SRI in bulk"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("inputs", nargs="+", help="Files or directories to read")
+    common.add_argument("-o", "--output", required=True, help="Output path")
+    common.add_argument("-q", "--quiet", action="store_true", help="No progress")
+
+    invoices = argparse.ArgumentParser(add_help=False)
+    invoices.add_argument(
+        "--trusted",
+        action="store_true",
+        help="Skip the validation of the invoices, see SRI.from_trusted",
+    )
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument(
+        "--workers", type=int, default=None, help="Worker processes, one per core"
+    )
+
+    certificate = argparse.ArgumentParser(add_help=False)
+    certificate.add_argument(
+        "--certificate",
+        default=os.environ.get("SRI_CERTIFICATE"),
+        help=".p12 certificate, defaults to $SRI_CERTIFICATE",
+    )
+    certificate.add_argument(
+        "--password",
+        default=os.environ.get("SRI_CERTIFICATE_PASSWORD"),
+        help="Certificate password, defaults to $SRI_CERTIFICATE_PASSWORD",
+    )
+
+    logo = argparse.ArgumentParser(add_help=False)
+    logo.add_argument("--logo", default=None, help="Logo of the RIDE")
+
+    command = commands.add_parser(
+        "render", parents=[common, invoices], help="Write the unsigned xml"
+    )
+    command.set_defaults(handler=render)
+
+    command = commands.add_parser(
+        "sign",
+        parents=[common, invoices, workers, certificate],
+        help="Sign into a directory or a .zip",
+    )
+    command.set_defaults(handler=sign)
+
+    for name, description in (
+        ("submit", "Sign and send to the SRI"),
+        ("authorize", "Sign, send and poll the authorization"),
+        ("run", "Sign, send, poll the authorization and render the RIDE"),
+    ):
+        command = commands.add_parser(
+            name,
+            parents=[common, invoices, workers, certificate, logo],
+            help=description,
+        )
+        command.add_argument(
+            "--concurrency", type=int, default=8, help="SRI calls in flight"
+        )
+        command.add_argument(
+            "--outbox", default=None, help="SQLite file to resume the run from"
+        )
+        command.add_argument("--poll-attempts", type=int, default=5)
+        command.add_argument("--poll-interval", type=float, default=3.0)
+        command.set_defaults(handler=pipeline)
+
+    command = commands.add_parser(
+        "pdf",
+        parents=[common, workers, logo],
+        help="Render the RIDE of authorized comprobantes",
+    )
+    command.set_defaults(handler=pdf)
+
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Function to run the command line tool
+    """
+    args = get_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Signing daemon serving many application processes over a Unix socket
+
+The daemon holds the decrypted certificates, requests of every connection are
+batched and signed on a process pool. Application processes render the xml
+and use SigningClient, so they never load the private keys.
+
+Messages are JSON objects prefixed by their length as a 4 byte big endian
+integer. A request is {"id": int, "xml": str, "ruc": str} and its response is
+{"id": int, "xml": str} or {"id": int, "error": str}.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from .signing import Certificate, load_certificate, sign_xml
+
+# Largest message accepted, a connection sending a larger one is closed
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+_header = struct.Struct(">I")
+
+# Certificate, or registry of certificates by RUC, of each worker process
+_certificate = None
+_registry = None
+
+
+class SigningError(Exception):
+    """
+    Error raised when the daemon could not sign a comprobante
+    """
+
+
+def _encode(message: dict) -> bytes:
+    data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    return _header.pack(len(data)) + data
+
+
+def _init_worker(certificate: Certificate, registry=None):
+    global _certificate, _registry
+    _certificate = certificate
+    _registry = registry
+
+
+def _sign_batch(
+    items: List[Tuple[str, Optional[str]]]
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    results = []
+
+    for xml, company_ruc in items:
+        try:
+            if _registry is not None and (company_ruc or _certificate is None):
+                certificate = _registry.get(company_ruc)
+            else:
+                certificate = _certificate
+
+            results.append((sign_xml(xml, certificate), None))
+        except Exception as e:
+            results.append((None, "{}: {}".format(type(e).__name__, e)))
+
+    return results
+
+
+class _Connection:
+    __slots__ = ("writer", "lock")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    async def send(self, message: dict):
+        async with self.lock:
+            if self.writer.is_closing():
+                return
+
+            self.writer.write(_encode(message))
+
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+
+
+class SigningServer:
+    """
+    Class for serving signing requests on a Unix socket
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        certificate_file_path: str = None,
+        password: str = None,
+        certificate: Certificate = None,
+        registry=None,
+        workers: int = None,
+        batch_size: int = 32,
+        batch_interval: float = 0.002,
+        mode: int = 0o600,
+    ):
+        """
+        Comprobantes are signed with the given certificate, or with the
+        certificate of their RUC when a CertificateRegistry is given
+
+        batch_size: maximum number of comprobantes sent at once to a worker
+        batch_interval: seconds waited for more requests to fill a batch
+        mode: permissions of the socket file
+        """
+        if certificate is None and registry is None:
+            certificate = load_certificate(certificate_file_path, password)
+
+        self.socket_path = socket_path
+        self.certificate = certificate
+        self.registry = registry
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.mode = mode
+
+        self._loop = None
+        self._stopping = None
+        self._connections = {}
+
+    def serve_forever(self):
+        """
+        Serve requests until stop is called
+        """
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """
+        Stop serving, it can be called from any thread
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def serve(self):
+        """
+        Serve requests until stop is called
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._requests = asyncio.Queue()
+
+        # Batches in flight, enough to keep every worker busy
+        self._in_flight = asyncio.Semaphore(self.workers * 2)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.certificate, self.registry),
+        )
+
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        os.chmod(self.socket_path, self.mode)
+
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self._loop.add_signal_handler(signum, self._stopping.set)
+
+        batcher = asyncio.ensure_future(self._batcher())
+
+        try:
+            await self._stopping.wait()
+        finally:
+            server.close()
+
+            # Open connections are closed so their handlers return
+            for writer in self._connections.values():
+                writer.close()
+
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await server.wait_closed()
+            batcher.cancel()
+            self._executor.shutdown(wait=True)
+
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = _Connection(writer)
+        task = asyncio.current_task()
+        self._connections[task] = writer
+
+        try:
+            while True:
+                (size,) = _header.unpack(await reader.readexactly(_header.size))
+
+                if size > MAX_MESSAGE_SIZE:
+                    break
+
+                request = json.loads(await reader.readexactly(size))
+
+                if not isinstance(request, dict):
+                    break
+
+                await self._requests.put((connection, request))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+
+    async def _batcher(self):
+        while True:
+            batch = [await self._requests.get()]
+            deadline = self._loop.time() + self.batch_interval
+
+            while len(batch) < self.batch_size:
+                timeout = deadline - self._loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._requests.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._in_flight.acquire()
+            asyncio.ensure_future(self._sign(batch))
+
+    async def _sign(self, batch: list):
+        try:
+            try:
+                results = await self._loop.run_in_executor(
+                    self._executor,
+                    _sign_batch,
+                    [(request.get("xml"), request.get("ruc")) for _, request in batch],
+                )
+            except Exception as e:
+                results = [(None, "{}: {}".format(type(e).__name__, e))] * len(batch)
+
+            for (connection, request), (xml_signed, error) in zip(batch, results):
+                if error is None:
+                    message = {"id": request.get("id"), "xml": xml_signed}
+                else:
+                    message = {"id": request.get("id"), "error": error}
+
+                # A reply that can not be sent does not hold back the others
+                try:
+                    await connection.send(message)
+                except Exception:
+                    pass
+        finally:
+            self._in_flight.release()
+
+
+class SigningClient:
+    """
+    Class for signing comprobantes with a signing daemon, it can be shared by
+    the threads of a process
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+        self._socket = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._socket is not None:
+                self._socket.close()
+                self._socket = None
+
+    def get_xml_signed(self, bill) -> str:
+        """
+        Function to get the signed xml of an invoice
+        """
+        return self.sign_xml(bill.get_xml(), company_ruc=bill.company_ruc)
+
+    def sign_xml(self, xml: str, company_ruc: str = None) -> str:
+        """
+        Function to sign the xml of a comprobante
+        """
+        with self._lock:
+            request_id = next(self._ids)
+            message = _encode({"id": request_id, "xml": xml, "ruc": company_ruc})
+
+            try:
+                response = self._request(message)
+            except ConnectionError:
+                # The daemon was restarted, the request is sent once more
+                self._disconnect()
+                response = self._request(message)
+
+        if response.get("id") != request_id:
+            raise SigningError("Unexpected response from the signing daemon")
+
+        if "error" in response:
+            raise SigningError(response["error"])
+
+        return response["xml"]
+
+    def _request(self, message: bytes) -> dict:
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect(self.socket_path)
+
+        try:
+            self._socket.sendall(message)
+            (size,) = _header.unpack(self._recv(_header.size))
+            return json.loads(self._recv(size))
+        except socket.timeout:
+            # A late response would be read by the next request
+            self._disconnect()
+            raise
+
+    def _recv(self, size: int) -> bytes:
+        data = bytearray()
+
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+
+            if not chunk:
+                raise ConnectionResetError("The signing daemon closed the connection")
+
+            data += chunk
+
+        return bytes(data)
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def main(argv: List[str] = None):
+    """
+    Function to run the signing daemon from the command line
+    """
+    parser = argparse.ArgumentParser(
+        prog="sri-signd", description="Sign comprobantes for many processes"
+    )
+    parser.add_argument("--socket", required=True, help="Unix socket path")
+    parser.add_argument("--certificate", required=True, help=".p12 certificate")
+    parser.add_argument(
+        "--password",
+        default=os.environ.get("SRI_CERTIFICATE_PASSWORD"),
+        help="Certificate password, defaults to $SRI_CERTIFICATE_PASSWORD",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batch-interval", type=float, default=0.002)
+    args = parser.parse_args(argv)
+
+    if args.password is None:
+        parser.error("the certificate password is required")
+
+    server = SigningServer(
+        args.socket,
+        certificate_file_path=args.certificate,
+        password=args.password,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        batch_interval=args.batch_interval,
+    )
+
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
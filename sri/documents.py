@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Document engine for the types of comprobantes
+
+Each document type has its template, compiled once per process. The access
+key, signing, validation, submission and caching are the same for every type,
+only the rendering of the comprobante is dispatched on its document_type.
+"""
+
+from functools import lru_cache
+from typing import NamedTuple
+
+from jinja2 import Template
+
+from .enum import DocumentTypeEnum
+
+
+class DocumentSpec(NamedTuple):
+    """
+    Template of a document type
+    """
+
+    template: str
+    root: str
+    version: str
+
+
+DOCUMENTS = {
+    DocumentTypeEnum.INVOICE: DocumentSpec("factura_V1.1.0.xml", "factura", "1.1.0"),
+    DocumentTypeEnum.NOTA_CREDITO: DocumentSpec(
+        "notaCredito_V1.1.0.xml", "notaCredito", "1.1.0"
+    ),
+    DocumentTypeEnum.NOTA_DEBITO: DocumentSpec(
+        "notaDebito_V1.0.0.xml", "notaDebito", "1.0.0"
+    ),
+}
+
+# Title of every document type in the RIDE, rendered or not
+TITLES = {
+    DocumentTypeEnum.INVOICE: "FACTURA",
+    DocumentTypeEnum.NOTA_CREDITO: "NOTA DE CRÉDITO",
+    DocumentTypeEnum.NOTA_DEBITO: "NOTA DE DÉBITO",
+    DocumentTypeEnum.GUIA_REMISION: "GUÍA DE REMISIÓN",
+    DocumentTypeEnum.RETENCION: "COMPROBANTE DE RETENCIÓN",
+}
+
+
+def get_document(document_type: DocumentTypeEnum) -> DocumentSpec:
+    """
+    Function to get the template of a document type, a ValueError is raised
+    if it can not be rendered
+    """
+    document_type = DocumentTypeEnum(document_type)
+
+    if document_type not in DOCUMENTS:
+        raise ValueError("unsupported document type {}".format(document_type.value))
+
+    return DOCUMENTS[document_type]
+
+
+def get_title(document_type: DocumentTypeEnum) -> str:
+    """
+    Function to get the title of a document type in the RIDE
+    """
+    return TITLES.get(DocumentTypeEnum(document_type), "COMPROBANTE")
+
+
+@lru_cache(maxsize=None)
+def get_template(document_type: DocumentTypeEnum) -> Template:
+    """
+    Function to get the compiled template of a document type
+    """
+    from . import loader
+
+    return loader.get_template(get_document(document_type).template)
+
+
+def render_xml(bill) -> str:
+    """
+    Function to render the xml of a comprobante of any supported type
+    """
+    modified_document_date = bill.modified_document_date
+
+    render = get_template(bill.document_type).render(
+        {
+            "bill": bill,
+            "claveAcceso": bill.get_access_key(),
+            "fechaEmision": bill.emission_date.strftime("%d/%m/%Y"),
+            "fechaEmisionDocSustento": modified_document_date.strftime("%d/%m/%Y")
+            if modified_document_date
+            else None,
+        }
+    )
+
+    return render.replace("\n", "")
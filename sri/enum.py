@@ -60,3 +60,15 @@ class PaymentMethodEnum(str, Enum):
 
 class UnitTimeEnum(str, Enum):
     DAY = "dias"
+
+
+class InvoiceStateEnum(str, Enum):
+    PENDING = "PENDIENTE"
+    SIGNED = "FIRMADA"
+    RECEIVED = "RECIBIDA"
+    RETURNED = "DEVUELTA"
+    PROCESSING = "EN PROCESO"
+    AUTHORIZED = "AUTORIZADO"
+    NOT_AUTHORIZED = "NO AUTORIZADO"
+    RENDERED = "RIDE"
+    FAILED = "ERROR"
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+Local index of issued access keys
+
+Keys are stored as fixed width records sorted by RUC, document type, serie,
+sequential and date in a memory mapped file, so membership and range queries
+are binary searches that only touch a few pages. A Bloom filter kept next to
+the index answers most lookups of keys that were never issued without
+touching the file at all.
+
+New keys are kept in memory and merged into the file on flush, adding keys in
+batches is much cheaper than flushing after each one.
+"""
+
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
+from datetime import date
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+ACCESS_KEY_LENGTH = 49
+
+# Sort key of an access key and a new line
+RECORD_SIZE = ACCESS_KEY_LENGTH + 1
+
+_bloom_header = struct.Struct("<QQ")
+
+
+class AccessKey(NamedTuple):
+    """
+    Fields of an access key
+    """
+
+    emission_date: date
+    document_type: str
+    company_ruc: str
+    environment: str
+    establishment: str
+    point_emission: str
+    sequential: str
+    numeric_code: str
+    emission_type: str
+    digit_verifier: int
+
+    @property
+    def serie(self) -> str:
+        return self.establishment + self.point_emission
+
+    @property
+    def access_key(self) -> str:
+        return "{}{}{}{}{}{}{}{}{}{}".format(
+            self.emission_date.strftime("%d%m%Y"),
+            self.document_type,
+            self.company_ruc,
+            self.environment,
+            self.establishment,
+            self.point_emission,
+            self.sequential,
+            self.numeric_code,
+            self.emission_type,
+            self.digit_verifier,
+        )
+
+
+def decode_access_key(access_key: str, verify: bool = True) -> AccessKey:
+    """
+    Function to decode an access key into its fields, a ValueError is raised
+    if it is malformed or its verification digit is wrong
+    """
+    from . import SRI
+
+    if len(access_key) != ACCESS_KEY_LENGTH or not access_key.isdigit():
+        raise ValueError("Invalid access key {!r}".format(access_key))
+
+    if verify and SRI.generate_digit_verifier(access_key[:-1]) != int(access_key[-1]):
+        raise ValueError("Invalid verification digit in {}".format(access_key))
+
+    return AccessKey(
+        emission_date=date(
+            int(access_key[4:8]), int(access_key[2:4]), int(access_key[0:2])
+        ),
+        document_type=access_key[8:10],
+        company_ruc=access_key[10:23],
+        environment=access_key[23],
+        establishment=access_key[24:27],
+        point_emission=access_key[27:30],
+        sequential=access_key[30:39],
+        numeric_code=access_key[39:47],
+        emission_type=access_key[47],
+        digit_verifier=int(access_key[48]),
+    )
+
+
+def _record(access_key: str) -> bytes:
+    """
+    Sort key of an access key: ruc, document type, serie, sequential, date as
+    yyyymmdd, environment, numeric code, emission type and verification digit
+    """
+    return (
+        access_key[10:23]
+        + access_key[8:10]
+        + access_key[24:39]
+        + access_key[4:8]
+        + access_key[2:4]
+        + access_key[0:2]
+        + access_key[23]
+        + access_key[39:49]
+    ).encode("ascii")
+
+
+def _access_key(record: bytes) -> str:
+    record = record.decode("ascii")
+
+    return (
+        record[36:38]
+        + record[34:36]
+        + record[30:34]
+        + record[13:15]
+        + record[0:13]
+        + record[38]
+        + record[15:30]
+        + record[39:49]
+    )
+
+
+def _get(mapping, index: int) -> bytes:
+    offset = index * RECORD_SIZE
+    return mapping[offset : offset + ACCESS_KEY_LENGTH]
+
+
+class BloomFilter:
+    """
+    Class for a Bloom filter of bytes
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(
+            8,
+            int(-self.capacity * math.log(error_rate) / math.log(2) ** 2),
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: bytes) -> Iterator[int]:
+        digest = hashlib.blake2b(value, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: bytes):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: bytes):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+class AccessKeyIndex:
+    """
+    Class for handling a sorted and memory mapped index of access keys
+    """
+
+    def __init__(self, path: str, bloom: bool = True, error_rate: float = 0.001):
+        """
+        path: file of the index, the Bloom filter is kept in path + ".bloom"
+        bloom: whether to use a Bloom filter for membership queries
+        """
+        self.path = path
+        self.bloom = bloom
+        self.error_rate = error_rate
+
+        self._pending = set()
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._filter = None
+        self._lock = threading.Lock()
+
+        if not os.path.exists(path):
+            open(path, "wb").close()
+
+        self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count + len(self._pending)
+
+    def __contains__(self, access_key: str):
+        with self._lock:
+            return self._contains(_record(access_key))
+
+    def add(self, access_key: str) -> bool:
+        """
+        Add an access key, False is returned if it was already issued
+        """
+        decode_access_key(access_key)
+        record = _record(access_key)
+
+        with self._lock:
+            if self._contains(record):
+                return False
+
+            self._pending.add(record)
+
+        return True
+
+    def update(self, access_keys: Iterable[str]) -> int:
+        """
+        Add many access keys and return how many were new
+        """
+        return sum(self.add(access_key) for access_key in access_keys)
+
+    def get(
+        self,
+        company_ruc: str,
+        document_type: str,
+        establishment: str,
+        point_emission: str,
+        sequential: str,
+    ) -> Optional[str]:
+        """
+        Return the access key of a comprobante or None if it was not issued
+        """
+        for key in self.find(
+            company_ruc,
+            document_type=document_type,
+            establishment=establishment,
+            point_emission=point_emission,
+            sequential_from=sequential,
+            sequential_to=sequential,
+        ):
+            return key.access_key
+
+        return None
+
+    def find(
+        self,
+        company_ruc: str,
+        document_type: str = None,
+        establishment: str = None,
+        point_emission: str = None,
+        sequential_from: str = None,
+        sequential_to: str = None,
+        date_from: date = None,
+        date_to: date = None,
+    ) -> Iterator[AccessKey]:
+        """
+        Iterate the access keys of a RUC in order of document type, serie and
+        sequential, the range is searched on the leading fields that are given
+        and the remaining ones are filtered
+        """
+        prefix = company_ruc
+        for value in (document_type, establishment, point_emission):
+            if value is None:
+                break
+            prefix += value
+
+        lower = upper = prefix
+
+        # The sequential range is searched only within a serie
+        if len(prefix) == 21:
+            lower += sequential_from or ""
+            upper += sequential_to or ""
+
+        lower = lower.encode("ascii")
+        upper = upper.encode("ascii") + b"\xff"
+
+        with self._lock:
+            pending = sorted(r for r in self._pending if lower <= r < upper)
+            start = self._bisect(lower)
+            end = self._bisect(upper)
+
+            # A flush replaces the map, the current one stays valid while used
+            mapping = self._map
+
+        records = heapq.merge((_get(mapping, i) for i in range(start, end)), pending)
+
+        for record in records:
+            # Keys were verified when they were added
+            key = decode_access_key(_access_key(record), verify=False)
+
+            if document_type is not None and key.document_type != document_type:
+                continue
+            if establishment is not None and key.establishment != establishment:
+                continue
+            if point_emission is not None and key.point_emission != point_emission:
+                continue
+            if sequential_from is not None and key.sequential < sequential_from:
+                continue
+            if sequential_to is not None and key.sequential > sequential_to:
+                continue
+            if date_from is not None and key.emission_date < date_from:
+                continue
+            if date_to is not None and key.emission_date > date_to:
+                continue
+
+            yield key
+
+    def flush(self):
+        """
+        Merge the keys added since the last flush into the index file
+        """
+        with self._lock:
+            if not self._pending:
+                return
+
+            pending = sorted(self._pending)
+            tmp_path = self.path + ".tmp"
+
+            with open(tmp_path, "wb") as f:
+                for record in heapq.merge(
+                    (self._get(i) for i in range(self._count)), pending
+                ):
+                    f.write(record + b"\n")
+
+            count = self._count + len(pending)
+
+            if self._filter is not None and count <= self._filter.capacity:
+                for record in pending:
+                    self._filter.add(record)
+                bloom = self._filter
+            else:
+                bloom = None
+
+            self._close()
+            os.replace(tmp_path, self.path)
+            self._pending.clear()
+            self._open(bloom)
+
+    def close(self):
+        """
+        Flush the index and close the file
+        """
+        self.flush()
+
+        with self._lock:
+            self._close()
+
+    def _get(self, index: int) -> bytes:
+        return _get(self._map, index)
+
+    def _contains(self, record: bytes) -> bool:
+        if record in self._pending:
+            return True
+
+        if self._filter is not None and record not in self._filter:
+            return False
+
+        index = self._bisect(record)
+        return index < self._count and self._get(index) == record
+
+    def _bisect(self, record: bytes) -> int:
+        lo, hi = 0, self._count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._get(mid) < record:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _open(self, bloom: BloomFilter = None):
+        self._file = open(self.path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+
+        if size % RECORD_SIZE:
+            raise ValueError("{} is not an access key index".format(self.path))
+
+        self._count = size // RECORD_SIZE
+        self._map = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+
+        if self.bloom:
+            self._filter = bloom or self._load_filter()
+
+            if bloom is not None:
+                self._save_filter()
+
+    def _close(self):
+        # The map is closed once it is no longer referenced by a find
+        if self._file is not None:
+            self._file.close()
+
+        self._map = b""
+        self._file = None
+
+    def _load_filter(self) -> BloomFilter:
+        bloom_path = self.path + ".bloom"
+
+        if os.path.exists(bloom_path):
+            with open(bloom_path, "rb") as f:
+                capacity, count = _bloom_header.unpack(f.read(_bloom_header.size))
+
+                if count == self._count:
+                    bloom = BloomFilter(capacity, self.error_rate)
+                    data = f.read()
+
+                    if len(data) == len(bloom.bits):
+                        bloom.bits[:] = data
+                        return bloom
+
+        # Missing or stale, it is built again with room to grow
+        bloom = BloomFilter(max(self._count * 2, 1 << 16), self.error_rate)
+
+        for i in range(self._count):
+            bloom.add(self._get(i))
+
+        self._filter = bloom
+        self._save_filter()
+
+        return bloom
+
+    def _save_filter(self):
+        with open(self.path + ".bloom", "wb") as f:
+            f.write(_bloom_header.pack(self._filter.capacity, self._count))
+            f.write(self._filter.bits)
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Operational metrics of the emission of comprobantes
+
+Counters, gauges and histograms are kept in a registry in memory and exported
+in the Prometheus text format, from exposition() or from a local scrape
+endpoint:
+
+    from sri import metrics
+
+    metrics.start_http_server(9464)
+
+Metrics are updated by the process that does the work. The pipeline signs and
+renders on worker processes, it observes those stages from the parent process
+so they are exported too.
+
+A comprobante counts as pending from its reception until the same process
+sees its final authorization state. Processes that only submit never see it,
+so pending comprobantes are forgotten after PENDING_TTL seconds and at most
+PENDING_MAXSIZE are tracked.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from signing a comprobante to a slow SOAP call
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(name, _escape(str(value)))
+            for name, value in zip(names, values)
+        )
+    )
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+class Registry:
+    """
+    Class for holding the metrics exported together
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError("Duplicated metric {}".format(metric.name))
+
+            self._metrics.append(metric)
+
+    def exposition(self) -> str:
+        """
+        Return the metrics in the Prometheus text format
+        """
+        lines = []
+
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            "{}{} {}".format(
+                self.name, _format_labels(self.labelnames, key), _format_value(value)
+            )
+            for key, value in values
+        ]
+
+
+class Counter(_Metric):
+    """
+    Class for a value that only goes up
+    """
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Class for a value that goes up and down
+    """
+
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """
+    Class for the distribution of observed values
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Registry = REGISTRY,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            values = self._values.get(key)
+
+            if values is None:
+                # Count of each bucket, then the +Inf bucket, the sum and count
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0, 0]
+
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def get(self, **labels) -> float:
+        """
+        Return the number of observed values
+        """
+        values = self._values.get(self._key(labels))
+        return values[-1] if values else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(value)) for key, value in self._values.items())
+
+        labelnames = self.labelnames + ("le",)
+        lines = []
+
+        for key, value in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), value):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(labelnames, key + (_format_value(bound),)),
+                        cumulative,
+                    )
+                )
+
+            labels = _format_labels(self.labelnames, key)
+            lines.append(
+                "{}_sum{} {}".format(self.name, labels, _format_value(value[-2]))
+            )
+            lines.append("{}_count{} {}".format(self.name, labels, value[-1]))
+
+        return lines
+
+
+SIGN_SECONDS = Histogram(
+    "sri_sign_seconds", "Time to sign a comprobante, its count is the signed ones"
+)
+RECEPTION_SECONDS = Histogram(
+    "sri_reception_seconds",
+    "Time of the calls to the reception web service by returned state",
+    ["state"],
+)
+AUTHORIZATION_SECONDS = Histogram(
+    "sri_authorization_seconds",
+    "Time of the calls to the authorization web service by returned state",
+    ["state"],
+)
+PDF_SECONDS = Histogram("sri_pdf_seconds", "Time to render the RIDE of a comprobante")
+ERRORS = Counter("sri_errors_total", "Operations that raised an error", ["operation"])
+PENDING_AUTHORIZATIONS = Gauge(
+    "sri_pending_authorizations",
+    "Comprobantes received by the SRI without a final authorization state",
+)
+
+# Seconds a comprobante is tracked without a final state, and how many are
+PENDING_TTL = 3600.0
+PENDING_MAXSIZE = 100000
+
+# Time each pending comprobante was received, oldest first
+_pending = OrderedDict()
+_pending_lock = threading.Lock()
+
+
+def set_pending(access_key: str, pending: bool):
+    """
+    Function to track a comprobante waiting for its authorization
+    """
+    now = time.monotonic()
+
+    with _pending_lock:
+        if pending:
+            _pending[access_key] = now
+            _pending.move_to_end(access_key)
+        else:
+            _pending.pop(access_key, None)
+
+        while _pending and (
+            len(_pending) > PENDING_MAXSIZE
+            or now - next(iter(_pending.values())) > PENDING_TTL
+        ):
+            _pending.popitem(last=False)
+
+        PENDING_AUTHORIZATIONS.set(len(_pending))
+
+
+@contextmanager
+def measure(histogram: Histogram, operation: str):
+    """
+    Context manager observing the time of its block in the histogram, the
+    labels are set by the block in the yielded dict. An error is counted in
+    sri_errors_total instead.
+    """
+    labels = {}
+    started = time.perf_counter()
+
+    try:
+        yield labels
+    except Exception:
+        ERRORS.inc(operation=operation)
+        raise
+
+    histogram.observe(time.perf_counter() - started, **labels)
+
+
+def exposition(registry: Registry = REGISTRY) -> str:
+    """
+    Function to get the metrics in the Prometheus text format
+    """
+    return registry.exposition()
+
+
+def start_http_server(
+    port: int = 9464, addr: str = "127.0.0.1", registry: Registry = REGISTRY
+) -> ThreadingHTTPServer:
+    """
+    Function to serve the metrics on http://addr:port/metrics from a daemon
+    thread, call shutdown on the returned server to stop it
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = registry.exposition().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
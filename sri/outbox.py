@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Durable outbox of the invoices in flight
+
+Every state transition is written to a local SQLite database in WAL mode
+together with the bill, the signed xml and the SRI responses, so processing can
+resume from the recorded state after a restart. Writes are buffered and
+committed in batches, a crash loses at most the last uncommitted batch, which
+is replayed from the previous recorded state.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from .enum import InvoiceStateEnum
+
+# States from which an invoice still has work to do
+PENDING_STATES = (
+    InvoiceStateEnum.PENDING,
+    InvoiceStateEnum.SIGNED,
+    InvoiceStateEnum.RECEIVED,
+    InvoiceStateEnum.PROCESSING,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    access_key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    bill TEXT,
+    xml_signed TEXT,
+    reception TEXT,
+    authorization TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invoices_state ON invoices (state);
+CREATE TABLE IF NOT EXISTS transitions (
+    access_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_access_key ON transitions (access_key);
+"""
+
+UPSERT = """
+INSERT INTO invoices (
+    access_key, state, bill, xml_signed, reception, authorization, error, updated_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (access_key) DO UPDATE SET
+    state = excluded.state,
+    bill = COALESCE(excluded.bill, bill),
+    xml_signed = COALESCE(excluded.xml_signed, xml_signed),
+    reception = COALESCE(excluded.reception, reception),
+    authorization = COALESCE(excluded.authorization, authorization),
+    error = excluded.error,
+    updated_at = excluded.updated_at
+"""
+
+# A failure keeps the last good state so the invoice is retried from there
+FAIL = """
+INSERT INTO invoices (access_key, state, error, updated_at)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (access_key) DO UPDATE SET
+    error = excluded.error,
+    updated_at = excluded.updated_at
+"""
+
+
+class OutboxRecord(NamedTuple):
+    """
+    Last recorded state of an invoice
+    """
+
+    access_key: str
+    state: InvoiceStateEnum
+    bill: Optional[str]
+    xml_signed: Optional[str]
+    reception: Optional[dict]
+    authorization: Optional[dict]
+    error: Optional[str]
+    updated_at: float
+
+
+def serialize_response(response) -> Optional[str]:
+    """
+    Function to serialize a SRI response to json
+    """
+    if response is None:
+        return None
+
+    if not isinstance(response, dict):
+        from zeep.helpers import serialize_object
+
+        response = serialize_object(response, dict)
+
+    return json.dumps(response, default=str)
+
+
+class Outbox:
+    """
+    Class for handling the durable record of the invoices in flight
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._updates = []
+        self._failures = []
+        self._transitions = []
+        self._flushed_at = time.monotonic()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(
+        self,
+        access_key: str,
+        state: InvoiceStateEnum,
+        bill: str = None,
+        xml_signed: str = None,
+        reception=None,
+        authorization=None,
+        error: str = None,
+    ):
+        """
+        Record a state transition, fields left as None keep their stored value
+        """
+        now = time.time()
+
+        with self._lock:
+            if state == InvoiceStateEnum.FAILED:
+                self._failures.append(
+                    (access_key, InvoiceStateEnum.PENDING.value, error, now)
+                )
+            else:
+                self._updates.append(
+                    (
+                        access_key,
+                        state.value,
+                        bill,
+                        xml_signed,
+                        serialize_response(reception),
+                        serialize_response(authorization),
+                        error,
+                        now,
+                    )
+                )
+
+            self._transitions.append((access_key, state.value, error, now))
+
+            # The stored times are wall clock, the interval is monotonic
+            if (
+                len(self._transitions) >= self.batch_size
+                or time.monotonic() - self._flushed_at >= self.flush_interval
+            ):
+                self._flush()
+
+    def record_job(self, job):
+        """
+        Record the state of a pipeline job, only the fields produced by the
+        stage it just left are written
+        """
+        fields = {}
+
+        if job.state == InvoiceStateEnum.PENDING:
+            fields["bill"] = job.bill.json()
+        elif job.state == InvoiceStateEnum.SIGNED:
+            fields["xml_signed"] = job.xml_signed
+        elif job.state in (InvoiceStateEnum.RECEIVED, InvoiceStateEnum.RETURNED):
+            fields["reception"] = job.reception
+        elif job.state in (
+            InvoiceStateEnum.PROCESSING,
+            InvoiceStateEnum.AUTHORIZED,
+            InvoiceStateEnum.NOT_AUTHORIZED,
+        ):
+            fields["authorization"] = job.authorization
+
+        self.record(job.access_key, job.state, error=job.error, **fields)
+
+    def flush(self):
+        """
+        Commit the buffered transitions
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        with self._connection:
+            if self._updates:
+                self._connection.executemany(UPSERT, self._updates)
+            if self._failures:
+                self._connection.executemany(FAIL, self._failures)
+            if self._transitions:
+                self._connection.executemany(
+                    "INSERT INTO transitions VALUES (?, ?, ?, ?)", self._transitions
+                )
+
+        self._updates = []
+        self._failures = []
+        self._transitions = []
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+    def _records(
+        self, query: str, args: tuple = (), flush: bool = True
+    ) -> Iterator[OutboxRecord]:
+        if flush:
+            self.flush()
+
+        for row in self._connection.execute(query, args):
+            yield OutboxRecord(
+                access_key=row[0],
+                state=InvoiceStateEnum(row[1]),
+                bill=row[2],
+                xml_signed=row[3],
+                reception=json.loads(row[4]) if row[4] else None,
+                authorization=json.loads(row[5]) if row[5] else None,
+                error=row[6],
+                updated_at=row[7],
+            )
+
+    def get(self, access_key: str, flush: bool = True) -> Optional[OutboxRecord]:
+        """
+        Return the last recorded state of an invoice, without flush the
+        buffered transitions are not committed nor seen
+        """
+        for record in self._records(
+            "SELECT * FROM invoices WHERE access_key = ?", (access_key,), flush
+        ):
+            return record
+
+        return None
+
+    def pending(self) -> Iterator[OutboxRecord]:
+        """
+        Return the invoices that still have work to do
+        """
+        states = tuple(state.value for state in PENDING_STATES)
+
+        return self._records(
+            "SELECT * FROM invoices WHERE state IN ({})".format(
+                ", ".join("?" * len(states))
+            ),
+            states,
+        )
+
+    def history(self, access_key: str) -> List[Tuple[InvoiceStateEnum, float]]:
+        """
+        Return the state transitions of an invoice
+        """
+        self.flush()
+
+        return [
+            (InvoiceStateEnum(state), at)
+            for state, at in self._connection.execute(
+                "SELECT state, at FROM transitions WHERE access_key = ? ORDER BY rowid",
+                (access_key,),
+            )
+        ]
+
+    def counts(self) -> dict:
+        """
+        Return the number of invoices in each state
+        """
+        self.flush()
+
+        return {
+            InvoiceStateEnum(state): count
+            for state, count in self._connection.execute(
+                "SELECT state, COUNT(*) FROM invoices GROUP BY state"
+            )
+        }
+
+    def jobs(self) -> Iterator:
+        """
+        Return pipeline jobs for the pending invoices, the bills were already
+        accepted once so they are rebuilt without validation. A record whose
+        bill can not be rebuilt is skipped and its error is recorded
+        """
+        from . import SRI
+
+        # Materialize first, the pipeline updates the rows while they are resumed
+        for record in list(self.pending()):
+            try:
+                bill = SRI.from_trusted(**json.loads(record.bill))
+            except Exception as e:
+                self.record(
+                    record.access_key,
+                    InvoiceStateEnum.FAILED,
+                    error="Invalid bill: {!r}".format(e),
+                )
+                continue
+
+            yield resume_job(record, bill)
+
+
+def resume_job(record: OutboxRecord, bill):
+    """
+    Function to get a pipeline job that resumes a pending invoice from its
+    recorded state
+    """
+    from .pipeline import Job
+
+    state = record.state
+
+    # Invoices still in process go back to polling the authorization
+    if state == InvoiceStateEnum.PROCESSING:
+        state = InvoiceStateEnum.RECEIVED
+
+    # Without the signed xml the invoice has to be signed again
+    if state != InvoiceStateEnum.PENDING and not record.xml_signed:
+        state = InvoiceStateEnum.PENDING
+
+    return Job(bill, state=state, xml_signed=record.xml_signed)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming parser of authorized comprobantes back into SRI models
+
+Authorization responses and exported files are read with iterparse and every
+element is released once it has been converted, so memory stays flat however
+many comprobantes the file holds. A lightweight mode extracts only the access
+keys and totals needed for reconciliation.
+
+Invoices, credit notes and debit notes are read. Invoices and credit notes are
+converted back into SRI, debit notes only have their totals: their taxes are
+not kept by line.
+"""
+
+from datetime import date, datetime
+from typing import IO, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from lxml import etree
+
+from .enum import InvoiceStateEnum
+
+_parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+# Info element and total of each comprobante by its root element
+COMPROBANTES = {
+    "factura": ("infoFactura", "importeTotal"),
+    "notaCredito": ("infoNotaCredito", "valorModificacion"),
+    "notaDebito": ("infoNotaDebito", "valorTotal"),
+}
+
+
+class InvoiceSummary(NamedTuple):
+    """
+    Access key and totals of a comprobante
+    """
+
+    access_key: str
+    document_type: str
+    company_ruc: str
+    emission_date: date
+    customer_identification: Optional[str]
+    total_without_tax: float
+    total_discount: float
+    grand_total: float
+    state: Optional[InvoiceStateEnum] = None
+    authorization_number: Optional[str] = None
+    authorization_date: Optional[str] = None
+
+
+def _text(element, path: str, default: str = None) -> Optional[str]:
+    child = element.find(path)
+
+    if child is None or child.text is None:
+        return default
+
+    return child.text.strip()
+
+
+def _float(element, path: str, default: float = 0) -> float:
+    value = _text(element, path)
+    return float(value) if value else default
+
+
+def _emission_date(value: str) -> date:
+    return datetime.strptime(value, "%d/%m/%Y").date()
+
+
+def _root(element) -> str:
+    """
+    Name of the root element of a comprobante, a ValueError is raised if it
+    is not a supported one
+    """
+    name = etree.QName(element).localname
+
+    if name not in COMPROBANTES:
+        raise ValueError("Unsupported comprobante {}".format(name))
+
+    return name
+
+
+def _release(element):
+    """
+    Free an element and the siblings already processed before it
+    """
+    element.clear(keep_tail=True)
+
+    parent = element.getparent()
+
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def _comprobante(authorization) -> Optional[etree._Element]:
+    """
+    Get the comprobante of an autorizacion element, it is usually sent as a
+    CDATA string but some exports embed the element
+    """
+    comprobante = authorization.find("{*}comprobante")
+
+    if comprobante is None:
+        return None
+
+    if len(comprobante):
+        return comprobante[0]
+
+    if comprobante.text and comprobante.text.strip():
+        return etree.fromstring(comprobante.text.strip().encode("utf-8"), _parser)
+
+    return None
+
+
+def iter_comprobantes(
+    source: Union[str, IO[bytes]]
+) -> Iterator[Tuple[Optional[dict], etree._Element]]:
+    """
+    Function to iterate the comprobantes of a file or file object, each one is
+    returned with the authorization that wraps it or None
+
+    The elements are released after the next item is requested, they must not
+    be kept by the caller.
+    """
+    for _, element in etree.iterparse(
+        source,
+        events=("end",),
+        tag=("{*}autorizacion",) + tuple("{*}" + name for name in COMPROBANTES),
+        resolve_entities=False,
+        no_network=True,
+        huge_tree=True,
+    ):
+        if etree.QName(element).localname in COMPROBANTES:
+            # Embedded in an autorizacion, it is returned with it
+            if any(
+                etree.QName(a).localname == "autorizacion"
+                for a in element.iterancestors()
+            ):
+                continue
+
+            yield None, element
+        else:
+            comprobante = _comprobante(element)
+
+            if comprobante is not None:
+                authorization = {
+                    "estado": _text(element, "{*}estado"),
+                    "numeroAutorizacion": _text(element, "{*}numeroAutorizacion"),
+                    "fechaAutorizacion": _text(element, "{*}fechaAutorizacion"),
+                    "ambiente": _text(element, "{*}ambiente"),
+                }
+                yield authorization, comprobante
+
+        _release(element)
+
+
+def invoice_data(element) -> dict:
+    """
+    Function to convert a factura or notaCredito element into the data of SRI
+    """
+    root = _root(element)
+
+    if root == "notaDebito":
+        raise ValueError("Debit notes can not be converted into SRI")
+
+    info_tributaria = element.find("infoTributaria")
+    info_factura = element.find(COMPROBANTES[root][0])
+    access_key = _text(info_tributaria, "claveAcceso")
+
+    lines_items = []
+    for detalle in element.iterfind("detalles/detalle"):
+        taxes = [
+            {
+                "code": _text(impuesto, "codigo"),
+                "tax_percentage_code": _text(impuesto, "codigoPorcentaje"),
+                "additional_discount": 0,
+                "base": _float(impuesto, "baseImponible"),
+                "value": _float(impuesto, "valor"),
+            }
+            for impuesto in detalle.iterfind("impuestos/impuesto")
+        ]
+        price_total_without_tax = _float(detalle, "precioTotalSinImpuesto")
+
+        lines_items.append(
+            {
+                "code": _text(
+                    detalle, "codigoPrincipal", _text(detalle, "codigoInterno", "")
+                ),
+                "aux_code": _text(
+                    detalle, "codigoAuxiliar", _text(detalle, "codigoAdicional", "")
+                ),
+                "description": _text(detalle, "descripcion", ""),
+                "quantity": int(_float(detalle, "cantidad")),
+                "unit_price": _float(detalle, "precioUnitario"),
+                "discount": _float(detalle, "descuento"),
+                "price_total_without_tax": price_total_without_tax,
+                "taxes": taxes,
+                "total_price": round(
+                    price_total_without_tax + sum(t["value"] for t in taxes), 2
+                ),
+            }
+        )
+
+    payments = [
+        {
+            "payment_method": _text(pago, "formaPago"),
+            "total": _float(pago, "total"),
+            "terms": int(_float(pago, "plazo")),
+            "unit_time": _text(pago, "unidadTiempo", "dias"),
+        }
+        for pago in info_factura.iterfind("pagos/pago")
+    ]
+
+    main_address = _text(info_tributaria, "dirMatriz", "")
+    modified_document_date = _text(info_factura, "fechaEmisionDocSustento")
+
+    return {
+        "environment": _text(info_tributaria, "ambiente"),
+        "emission_type": _text(info_tributaria, "tipoEmision"),
+        "billing_name": _text(info_tributaria, "razonSocial"),
+        "company_name": _text(
+            info_tributaria, "nombreComercial", _text(info_tributaria, "razonSocial")
+        ),
+        "company_ruc": _text(info_tributaria, "ruc"),
+        "document_type": _text(info_tributaria, "codDoc"),
+        "establishment": _text(info_tributaria, "estab"),
+        "point_emission": _text(info_tributaria, "ptoEmi"),
+        "sequential": _text(info_tributaria, "secuencial"),
+        "main_address": main_address,
+        "regimen": _text(info_tributaria, "contribuyenteRimpe"),
+        # The numeric code is only stored inside the access key
+        "numeric_code": access_key[39:47],
+        "emission_date": _emission_date(_text(info_factura, "fechaEmision")),
+        "company_address": _text(info_factura, "dirEstablecimiento", main_address),
+        "company_contribuyente_especial": _text(info_factura, "contribuyenteEspecial"),
+        "company_obligado_contabilidad": _text(
+            info_factura, "obligadoContabilidad", "NO"
+        ),
+        "customer_identification_type": _text(
+            info_factura, "tipoIdentificacionComprador"
+        ),
+        "customer_billing_name": _text(info_factura, "razonSocialComprador", ""),
+        "customer_identification": _text(info_factura, "identificacionComprador", ""),
+        "customer_address": _text(info_factura, "direccionComprador", ""),
+        "tips": _float(info_factura, "propina"),
+        "payments": payments,
+        "lines_items": lines_items,
+        "modified_document_type": _text(info_factura, "codDocModificado"),
+        "modified_document_number": _text(info_factura, "numDocModificado"),
+        "modified_document_date": _emission_date(modified_document_date)
+        if modified_document_date
+        else None,
+        "reason": _text(info_factura, "motivo"),
+    }
+
+
+def invoice_from_element(element, validate: bool = False):
+    """
+    Function to convert a factura or notaCredito element into SRI, authorized
+    comprobantes were already validated by the SRI so validation is skipped by
+    default
+    """
+    from . import SRI
+
+    data = invoice_data(element)
+
+    if validate:
+        return SRI(**data)
+
+    return SRI.from_trusted(**data)
+
+
+def invoice_from_xml(xml: Union[str, bytes], validate: bool = False):
+    """
+    Function to convert the xml of a factura or notaCredito into SRI
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+
+    return invoice_from_element(etree.fromstring(xml, _parser), validate=validate)
+
+
+def iter_invoices(source: Union[str, IO[bytes]], validate: bool = False) -> Iterator:
+    """
+    Function to iterate the invoices of an authorization response or of an
+    exported file as SRI instances
+    """
+    for _, element in iter_comprobantes(source):
+        yield invoice_from_element(element, validate=validate)
+
+
+def summary_from_element(element, authorization: dict = None) -> InvoiceSummary:
+    """
+    Function to extract the access key and totals of a comprobante element
+    """
+    info, total = COMPROBANTES[_root(element)]
+    info_tributaria = element.find("infoTributaria")
+    info_factura = element.find(info)
+
+    state = None
+    if authorization is not None and authorization["estado"]:
+        state = InvoiceStateEnum(authorization["estado"])
+
+    return InvoiceSummary(
+        access_key=_text(info_tributaria, "claveAcceso"),
+        document_type=_text(info_tributaria, "codDoc"),
+        company_ruc=_text(info_tributaria, "ruc"),
+        emission_date=_emission_date(_text(info_factura, "fechaEmision")),
+        customer_identification=_text(info_factura, "identificacionComprador"),
+        total_without_tax=_float(info_factura, "totalSinImpuestos"),
+        total_discount=_float(info_factura, "totalDescuento"),
+        grand_total=_float(info_factura, total),
+        state=state,
+        authorization_number=authorization and authorization["numeroAutorizacion"],
+        authorization_date=authorization and authorization["fechaAutorizacion"],
+    )
+
+
+def iter_totals(source: Union[str, IO[bytes]]) -> Iterator[InvoiceSummary]:
+    """
+    Function to iterate the access keys and totals of the comprobantes of a
+    file without building the invoices
+    """
+    for authorization, element in iter_comprobantes(source):
+        yield summary_from_element(element, authorization)
+
+
+def parse_authorization(response, validate: bool = False) -> List:
+    """
+    Function to get the invoices of the response of get_authorization
+    """
+    if not response or not response["autorizaciones"]:
+        return []
+
+    return [
+        invoice_from_xml(authorization["comprobante"], validate=validate)
+        for authorization in response["autorizaciones"]["autorizacion"]
+        if authorization["comprobante"]
+    ]
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+Emission pipeline: sign -> validate -> authorize -> pdf
+
+CPU bound stages (signing and pdf rendering) run on a process pool, the SOAP
+stages run on asyncio with a bounded number of calls in flight. Stages are
+connected by bounded queues so a slow stage applies backpressure upstream.
+"""
+
+import asyncio
+import functools
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+from . import get_authorization_date, get_authorization_state, metrics
+from .cache import get_xml_digest
+from .enum import InvoiceStateEnum
+from .signing import Certificate, load_certificate, sign_xml
+
+STAGE_SIGN = "sign"
+STAGE_VALIDATE = "validate"
+STAGE_AUTHORIZE = "authorize"
+STAGE_PDF = "pdf"
+
+STAGES = (STAGE_SIGN, STAGE_VALIDATE, STAGE_AUTHORIZE, STAGE_PDF)
+
+# Sentinel used to tell the workers of a stage that there is no more work
+_DONE = object()
+
+# Certificate, or registry of certificates by RUC, of each worker process
+_certificate = None
+_registry = None
+
+
+class PipelineEvent(NamedTuple):
+    """
+    Status event emitted each time an invoice leaves a stage
+    """
+
+    access_key: str
+    stage: str
+    state: InvoiceStateEnum
+    elapsed: float
+    error: Optional[str] = None
+
+
+class PipelineResult(NamedTuple):
+    """
+    Final result of an invoice that went through the pipeline
+    """
+
+    access_key: str
+    state: InvoiceStateEnum
+    xml_signed: Optional[str] = None
+    reception: Any = None
+    authorization: Any = None
+    pdf: Optional[bytes] = None
+    error: Optional[str] = None
+
+
+class Job:
+    """
+    Class for handling an invoice while it is in the pipeline
+    """
+
+    __slots__ = (
+        "bill",
+        "access_key",
+        "state",
+        "xml_signed",
+        "xml_digest",
+        "reception",
+        "authorization",
+        "pdf",
+        "error",
+    )
+
+    def __init__(self, bill, state=InvoiceStateEnum.PENDING, xml_signed=None):
+        self.bill = bill
+        self.access_key = bill.get_access_key()
+        self.state = state
+        self.xml_signed = xml_signed
+        self.xml_digest = None
+        self.reception = None
+        self.authorization = None
+        self.pdf = None
+        self.error = None
+
+    def result(self) -> PipelineResult:
+        return PipelineResult(
+            access_key=self.access_key,
+            state=self.state,
+            xml_signed=self.xml_signed,
+            reception=self.reception,
+            authorization=self.authorization,
+            pdf=self.pdf,
+            error=self.error,
+        )
+
+
+class _Run:
+    """
+    State of one run of the pipeline, runs of the same pipeline can overlap
+    """
+
+    __slots__ = ("cpu", "io", "queues", "results")
+
+    def __init__(self, cpu, io, queues: dict):
+        self.cpu = cpu
+        self.io = io
+        self.queues = queues
+        self.results = []
+
+
+def _init_worker(certificate: Certificate, registry=None):
+    global _certificate, _registry
+    _certificate = certificate
+    _registry = registry
+
+
+# Workers are other processes, they return the time of the work itself so the
+# parent does not observe the time waiting in the pool's queue
+def _sign(
+    bill, xml_signed: str = None, xml_digest: str = None
+) -> Tuple[str, str, Optional[float]]:
+    started = time.perf_counter()
+
+    # The document is rendered once, for its digest and for signing
+    xml = bill.get_xml()
+    digest = get_xml_digest(xml)
+
+    # A signature cached for the same document is reused
+    if xml_signed is not None and xml_digest == digest:
+        return xml_signed, digest, None
+
+    if _registry is not None:
+        certificate = _registry.get(bill.company_ruc)
+    else:
+        certificate = _certificate
+
+    return sign_xml(xml, certificate), digest, time.perf_counter() - started
+
+
+def _render_pdf(
+    bill, authorization_date: datetime, logo_file_path: str
+) -> Tuple[bytes, float]:
+    started = time.perf_counter()
+    pdf = bytes(bill.get_pdf(authorization_date, logo_file_path=logo_file_path))
+
+    return pdf, time.perf_counter() - started
+
+
+class Pipeline:
+    """
+    Class for handling the emission of many invoices concurrently
+    """
+
+    def __init__(
+        self,
+        certificate_file_path: str = None,
+        password: str = None,
+        certificate: Certificate = None,
+        workers: int = None,
+        concurrency: int = 8,
+        queue_size: int = 64,
+        poll_attempts: int = 5,
+        poll_interval: float = 3.0,
+        render_pdf: bool = True,
+        last_stage: str = STAGE_PDF,
+        logo_file_path: str = None,
+        on_event: Callable[[PipelineEvent], None] = None,
+        on_result: Callable[[PipelineResult], None] = None,
+        outbox=None,
+        cache=None,
+        registry=None,
+    ):
+        """
+        Invoices are signed with the given certificate, or with the
+        certificate of their RUC when a CertificateRegistry is given, they
+        are finished after last_stage
+        """
+        if certificate is None and registry is None:
+            certificate = load_certificate(certificate_file_path, password)
+
+        self.certificate = certificate
+        self.workers = workers
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.poll_attempts = poll_attempts
+        self.poll_interval = poll_interval
+        self.render_pdf = render_pdf
+        self.last_stage = last_stage
+        self.logo_file_path = logo_file_path
+        self.on_event = on_event
+        self.on_result = on_result
+        self.outbox = outbox
+        self.cache = cache
+        self.registry = registry
+
+    def run(self, bills: Iterable) -> List[PipelineResult]:
+        """
+        Run every invoice through the pipeline and wait for them to finish
+        """
+        return asyncio.run(self.run_async(bills))
+
+    async def run_async(self, bills: Iterable) -> List[PipelineResult]:
+        """
+        Run every invoice through the pipeline, results are returned when no
+        on_result callback was given
+        """
+        return await self.run_jobs(Job(bill) for bill in bills)
+
+    def resume(self) -> List[PipelineResult]:
+        """
+        Run the pending invoices recorded in the outbox from their last state
+        """
+        return asyncio.run(self.run_jobs(self.outbox.jobs()))
+
+    async def run_jobs(self, jobs: Iterable[Job]) -> List[PipelineResult]:
+        """
+        Run jobs through the pipeline, each job enters at the stage that
+        follows its current state
+        """
+        cpu_workers = self.workers or os.cpu_count() or 1
+
+        to_sign = asyncio.Queue(self.queue_size)
+        to_validate = asyncio.Queue(self.queue_size)
+        to_authorize = asyncio.Queue(self.queue_size)
+        to_pdf = asyncio.Queue(self.queue_size)
+
+        queues = {
+            InvoiceStateEnum.PENDING: to_sign,
+            InvoiceStateEnum.SIGNED: to_validate,
+            InvoiceStateEnum.RECEIVED: to_authorize,
+            InvoiceStateEnum.AUTHORIZED: to_pdf if self.render_pdf else None,
+        }
+
+        for state, stage in (
+            (InvoiceStateEnum.SIGNED, STAGE_SIGN),
+            (InvoiceStateEnum.RECEIVED, STAGE_VALIDATE),
+            (InvoiceStateEnum.AUTHORIZED, STAGE_AUTHORIZE),
+        ):
+            if STAGES.index(stage) >= STAGES.index(self.last_stage):
+                queues[state] = None
+
+        run = _Run(
+            ProcessPoolExecutor(
+                max_workers=cpu_workers,
+                initializer=_init_worker,
+                initargs=(self.certificate, self.registry),
+            ),
+            ThreadPoolExecutor(max_workers=self.concurrency * 2),
+            queues,
+        )
+
+        async def feed():
+            for job in jobs:
+                if self.outbox is not None and job.state == InvoiceStateEnum.PENDING:
+                    self.outbox.record_job(job)
+
+                await self._queue_for(run, job)
+
+        stages = [
+            (to_sign, cpu_workers, self._do_sign),
+            (to_validate, self.concurrency, self._do_validate),
+            (to_authorize, self.concurrency, self._do_authorize),
+            (to_pdf, cpu_workers, self._do_pdf),
+        ]
+
+        tasks = [asyncio.ensure_future(feed())]
+        for queue, count, handler in stages:
+            tasks.extend(
+                asyncio.ensure_future(self._worker(run, queue, handler))
+                for _ in range(count)
+            )
+
+        async def close():
+            # A stage only receives work from the feeder and the stage before
+            # it, so it can be closed once those are finished
+            await tasks[0]
+            position = 1
+
+            for queue, count, _ in stages:
+                for _ in range(count):
+                    await queue.put(_DONE)
+
+                await asyncio.gather(*tasks[position : position + count])
+                position += count
+
+        tasks.append(asyncio.ensure_future(close()))
+
+        try:
+            # A worker that dies would leave the stages before it blocked on
+            # its queue, so the run is cancelled with its error
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            run.cpu.shutdown()
+            run.io.shutdown()
+
+            if self.outbox is not None:
+                self.outbox.flush()
+
+        return run.results
+
+    async def _worker(self, run: _Run, queue: asyncio.Queue, handler):
+        while True:
+            job = await queue.get()
+
+            if job is _DONE:
+                break
+
+            await handler(run, job)
+
+    async def _queue_for(self, run: _Run, job: Job):
+        """
+        Send the job to the stage that follows its state, or finish it
+        """
+        queue = run.queues.get(job.state)
+
+        if queue is None:
+            self._finish(run, job)
+        else:
+            await queue.put(job)
+
+    def _emit(self, job: Job, stage: str, started: float):
+        if self.outbox is not None:
+            self.outbox.record_job(job)
+
+        if self.on_event is not None:
+            self.on_event(
+                PipelineEvent(
+                    access_key=job.access_key,
+                    stage=stage,
+                    state=job.state,
+                    elapsed=time.perf_counter() - started,
+                    error=job.error,
+                )
+            )
+
+    def _finish(self, run: _Run, job: Job):
+        result = job.result()
+
+        if self.on_result is not None:
+            self.on_result(result)
+        else:
+            run.results.append(result)
+
+    def _fail(self, run: _Run, job: Job, stage: str, started: float):
+        job.state = InvoiceStateEnum.FAILED
+        job.error = traceback.format_exc(limit=1)
+        self._emit(job, stage, started)
+        self._finish(run, job)
+
+    async def _do_sign(self, run: _Run, job: Job):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            cached = None
+
+            if self.cache is not None:
+                cached = self.cache.get(job.access_key)
+
+            if cached is not None:
+                signature = (cached.xml_signed, cached.xml_digest)
+            else:
+                signature = ()
+
+            xml_signed, xml_digest, seconds = await loop.run_in_executor(
+                run.cpu, _sign, job.bill, *signature
+            )
+
+            if seconds is not None:
+                metrics.SIGN_SECONDS.observe(seconds)
+
+                if self.cache is not None:
+                    self.cache.set_signed(job.access_key, xml_signed, xml_digest)
+
+            job.xml_signed = xml_signed
+            job.xml_digest = xml_digest
+        except Exception:
+            metrics.ERRORS.inc(operation="sign")
+            return self._fail(run, job, STAGE_SIGN, started)
+
+        job.state = InvoiceStateEnum.SIGNED
+        self._emit(job, STAGE_SIGN, started)
+
+        await self._queue_for(run, job)
+
+    async def _do_validate(self, run: _Run, job: Job):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            is_valid, job.reception = await loop.run_in_executor(
+                run.io,
+                functools.partial(
+                    job.bill.validate_xml_signed,
+                    job.xml_signed,
+                    cache=self.cache,
+                    xml_digest=job.xml_digest,
+                ),
+            )
+        except Exception:
+            return self._fail(run, job, STAGE_VALIDATE, started)
+
+        if is_valid:
+            job.state = InvoiceStateEnum.RECEIVED
+        else:
+            job.state = InvoiceStateEnum.RETURNED
+
+        self._emit(job, STAGE_VALIDATE, started)
+
+        await self._queue_for(run, job)
+
+    async def _do_authorize(self, run: _Run, job: Job):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            for attempt in range(self.poll_attempts):
+                if attempt:
+                    await asyncio.sleep(self.poll_interval)
+
+                _, job.authorization = await loop.run_in_executor(
+                    run.io,
+                    functools.partial(job.bill.get_authorization, cache=self.cache),
+                )
+                job.state = get_authorization_state(job.authorization)
+
+                if job.state != InvoiceStateEnum.PROCESSING:
+                    break
+        except Exception:
+            return self._fail(run, job, STAGE_AUTHORIZE, started)
+
+        self._emit(job, STAGE_AUTHORIZE, started)
+
+        await self._queue_for(run, job)
+
+    async def _do_pdf(self, run: _Run, job: Job):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+
+        try:
+            job.pdf, seconds = await loop.run_in_executor(
+                run.cpu,
+                _render_pdf,
+                job.bill,
+                get_authorization_date(job.authorization),
+                self.logo_file_path,
+            )
+            metrics.PDF_SECONDS.observe(seconds)
+        except Exception:
+            metrics.ERRORS.inc(operation="pdf")
+            return self._fail(run, job, STAGE_PDF, started)
+
+        job.state = InvoiceStateEnum.RENDERED
+        self._emit(job, STAGE_PDF, started)
+
+        self._finish(run, job)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Certificate registry for emitting invoices of many companies
+
+Certificates are registered by RUC and decrypted on demand. A bounded LRU of
+decrypted certificates is kept warm, a certificate is loaded again when its
+file changes and an expired certificate is refused before signing.
+
+Resolving and decrypting a certificate happens outside the registry lock, a
+RUC being loaded only makes the other callers of that RUC wait.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from .signing import Certificate, load_certificate
+
+
+class CertificateError(Exception):
+    """
+    Error raised when there is no usable certificate for a RUC
+    """
+
+
+class CertificateExpiredError(CertificateError):
+    """
+    Error raised when the certificate of a RUC is expired
+    """
+
+
+class CertificateSource(NamedTuple):
+    """
+    Location of the .p12 certificate of a RUC
+    """
+
+    certificate_file_path: str
+    password: str
+
+
+class _Entry:
+    __slots__ = ("certificate", "not_after", "mtime", "checked_at")
+
+    def __init__(self, certificate: Certificate, mtime: Tuple[float, int]):
+        self.certificate = certificate
+        self.not_after = certificate.not_after
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+
+def _mtime(path: str) -> Tuple[float, int]:
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+class CertificateRegistry:
+    """
+    Class for handling the certificates of many companies by RUC
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 64,
+        resolver: Callable[[str], Tuple[str, str]] = None,
+        check_interval: float = 1.0,
+        expiry_margin: timedelta = timedelta(0),
+    ):
+        """
+        maxsize: number of decrypted certificates kept in memory
+        resolver: function returning the file path and password of a RUC that
+            was not registered, e.g. from a secrets store
+        check_interval: seconds between checks of the certificate file
+        expiry_margin: certificates expiring within this margin are refused
+        """
+        self.maxsize = maxsize
+        self.resolver = resolver
+        self.check_interval = check_interval
+        self.expiry_margin = expiry_margin
+
+        self._sources: Dict[str, CertificateSource] = {}
+        self._expirations: Dict[str, datetime] = {}
+        self._warm = OrderedDict()
+        self._lock = threading.Lock()
+        # Lock of each RUC held while its certificate is loaded
+        self._loading: Dict[str, threading.Lock] = {}
+
+    def __getstate__(self):
+        # Decrypted certificates are not sent to other processes
+        return {
+            "maxsize": self.maxsize,
+            "resolver": self.resolver,
+            "check_interval": self.check_interval,
+            "expiry_margin": self.expiry_margin,
+            "sources": self._sources,
+        }
+
+    def __setstate__(self, state):
+        sources = state.pop("sources")
+        self.__init__(**state)
+        self._sources.update(sources)
+
+    def __len__(self):
+        return len(self._warm)
+
+    def __contains__(self, company_ruc: str):
+        return company_ruc in self._warm
+
+    def register(self, company_ruc: str, certificate_file_path: str, password: str):
+        """
+        Register the certificate of a RUC, it is decrypted when first used
+        """
+        with self._lock:
+            self._sources[company_ruc] = CertificateSource(
+                certificate_file_path, password
+            )
+            self._warm.pop(company_ruc, None)
+
+    def evict(self, company_ruc: str):
+        """
+        Remove the decrypted certificate of a RUC from memory
+        """
+        with self._lock:
+            self._warm.pop(company_ruc, None)
+
+    def get(self, company_ruc: str) -> Certificate:
+        """
+        Return the decrypted certificate of a RUC
+        """
+        check = False
+
+        with self._lock:
+            entry = self._warm.get(company_ruc)
+
+            if entry is not None:
+                self._warm.move_to_end(company_ruc)
+                source = self._sources[company_ruc]
+
+                now = time.monotonic()
+                if now - entry.checked_at >= self.check_interval:
+                    entry.checked_at = now
+                    check = True
+
+        # The file changed, e.g. the certificate was renewed
+        if check and _mtime(source.certificate_file_path) != entry.mtime:
+            entry = self._load(company_ruc, stale=entry)
+        elif entry is None:
+            entry = self._load(company_ruc)
+
+        if entry.not_after <= datetime.utcnow() + self.expiry_margin:
+            raise CertificateExpiredError(
+                "The certificate of {} expired on {}".format(
+                    company_ruc, entry.not_after
+                )
+            )
+
+        return entry.certificate
+
+    def sign(self, bill) -> str:
+        """
+        Sign an invoice with the certificate of its RUC
+        """
+        return bill.get_xml_signed(certificate=self.get(bill.company_ruc))
+
+    def expiring(self, within: timedelta) -> List[Tuple[str, datetime]]:
+        """
+        Return the RUCs whose certificate expires within the given time, only
+        certificates that were loaded at least once are known
+        """
+        limit = datetime.utcnow() + within
+
+        return sorted(
+            (
+                (company_ruc, not_after)
+                for company_ruc, not_after in self._expirations.items()
+                if not_after <= limit
+            ),
+            key=lambda item: item[1],
+        )
+
+    def _get_source(self, company_ruc: str) -> CertificateSource:
+        with self._lock:
+            source = self._sources.get(company_ruc)
+
+        if source is None and self.resolver is not None:
+            resolved = self.resolver(company_ruc)
+
+            if resolved is not None:
+                source = CertificateSource(*resolved)
+
+                with self._lock:
+                    source = self._sources.setdefault(company_ruc, source)
+
+        if source is None:
+            raise CertificateError(
+                "There is no certificate registered for {}".format(company_ruc)
+            )
+
+        return source
+
+    def _load(self, company_ruc: str, stale: _Entry = None) -> _Entry:
+        with self._lock:
+            loading = self._loading.setdefault(company_ruc, threading.Lock())
+
+        with loading:
+            # Loaded by another caller while this one was waiting
+            with self._lock:
+                entry = self._warm.get(company_ruc)
+
+            if entry is not None and entry is not stale:
+                return entry
+
+            source = self._get_source(company_ruc)
+            mtime = _mtime(source.certificate_file_path)
+            entry = _Entry(
+                load_certificate(source.certificate_file_path, source.password), mtime
+            )
+
+            with self._lock:
+                self._warm[company_ruc] = entry
+                self._warm.move_to_end(company_ruc)
+                self._expirations[company_ruc] = entry.not_after
+
+                while len(self._warm) > self.maxsize:
+                    self._warm.popitem(last=False)
+
+            return entry
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Certificate loading and XAdES signing of comprobantes
+"""
+
+from datetime import datetime
+
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from lxml import etree
+from OpenSSL import crypto
+from signxml import DigestAlgorithm
+from signxml.xades import XAdESDataObjectFormat
+
+from .XAdESSigner import MyXAdESSigner
+
+
+class Certificate:
+    """
+    Class for handling a decrypted .p12 certificate
+
+    The PEM key and certificate are kept so the object can be pickled and sent
+    to worker processes, the parsed private key is loaded once per process.
+    """
+
+    def __init__(self, key: bytes, cert: bytes):
+        self.key = key
+        self.cert = cert
+        self._private_key = None
+
+    def __getstate__(self):
+        return {"key": self.key, "cert": self.cert}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def not_after(self) -> datetime:
+        """
+        Return the expiration date of the certificate in UTC
+        """
+        x509 = crypto.load_certificate(crypto.FILETYPE_PEM, self.cert)
+        return datetime.strptime(x509.get_notAfter().decode(), "%Y%m%d%H%M%SZ")
+
+    @property
+    def private_key(self):
+        """
+        Return the parsed private key
+        """
+        if self._private_key is None:
+            self._private_key = load_pem_private_key(self.key, password=None)
+
+        return self._private_key
+
+
+def load_certificate(certificate_file_path: str, password: str) -> Certificate:
+    """
+    Function to decrypt a .p12 certificate file
+    """
+    with open(certificate_file_path, "rb") as f:
+        p12 = crypto.load_pkcs12(f.read(), password.encode("utf-8"))
+
+    # PEM formatted private key
+    key = crypto.dump_privatekey(crypto.FILETYPE_PEM, p12.get_privatekey())
+
+    # PEM formatted certificate
+    cert = crypto.dump_certificate(crypto.FILETYPE_PEM, p12.get_certificate())
+
+    return Certificate(key=key, cert=cert)
+
+
+def get_signer() -> MyXAdESSigner:
+    """
+    Function to get a signer configured as the SRI expects
+    """
+    data_object_format = XAdESDataObjectFormat(
+        Description="contenido comprobante",
+        MimeType="text/xml",
+    )
+    return MyXAdESSigner(
+        data_object_format=data_object_format,
+        c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315",
+        signature_algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1",
+        digest_algorithm=DigestAlgorithm.SHA1,
+    )
+
+
+def sign_xml(xml: str, certificate: Certificate) -> str:
+    """
+    Function to sign the xml of a comprobante
+    """
+    data = etree.fromstring(xml.encode("utf-8"))
+
+    signed_doc = get_signer().sign(
+        data,
+        key=certificate.private_key,
+        cert=certificate.cert.decode("utf-8"),
+        reference_uri=["#comprobante"],
+    )
+
+    return etree.tostring(
+        signed_doc, pretty_print=True, encoding="unicode", method="xml"
+    )
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Client side traffic control of the SRI web services
+
+Every SOAP call of a process goes through the traffic controller of its
+environment, shared by all the SRI instances:
+
+- a token bucket limits the rate of calls
+- the number of calls in flight adapts to the SRI (AIMD): it grows by one per
+  round of fast successful calls and is halved on slow or failed calls
+- a circuit breaker fails fast while the SRI is failing and lets a trial call
+  through once the reset timeout has passed, only the trial call closes it
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from .enum import EnvironmentEnum
+
+
+class CircuitOpenError(Exception):
+    """
+    Error raised when a call is refused because the SRI is failing
+    """
+
+
+class TokenBucket:
+    """
+    Class for limiting the rate of calls, burst calls can be made at once
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a call is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """
+    Class for limiting the calls in flight with additive increase and
+    multiplicative decrease driven by latency and errors, the limit is cut at
+    most once per window: calls started before the last cut do not cut it
+    again
+    """
+
+    def __init__(
+        self,
+        initial: int = 8,
+        minimum: int = 1,
+        maximum: int = 64,
+        target_latency: float = 2.0,
+        decrease_factor: float = 0.5,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        # Ticket of the last call admitted and of the last one when cut
+        self._ticket = 0
+        self._cut_at = 0
+
+    def acquire(self) -> int:
+        """
+        Wait until there is room for another call in flight, the returned
+        ticket is given back to release
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+
+            self.in_flight += 1
+            self._ticket += 1
+
+            return self._ticket
+
+    def release(self, latency: float, error: bool, ticket: int = None):
+        """
+        Record the outcome of a call and adapt the limit
+        """
+        with self._condition:
+            self.in_flight -= 1
+
+            if error or latency > self.target_latency:
+                # Calls in flight when the limit was cut saw the same overload
+                if ticket is None or ticket > self._cut_at:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._cut_at = self._ticket
+            else:
+                # Grows by one once every call of the current window succeeded
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+
+class CircuitBreaker:
+    """
+    Class for failing fast after consecutive failures, the outcome of calls
+    started before the breaker opened is ignored while it is not closed
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self) -> bool:
+        """
+        Raise CircuitOpenError if the call is not allowed, the returned trial
+        flag is given back to record
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(
+                        "The SRI is failing, calls are refused for {:.0f}s".format(
+                            self.reset_timeout
+                        )
+                    )
+
+                self.state = self.HALF_OPEN
+                self._trial = False
+
+            # Half open, a single trial call is let through
+            if self._trial:
+                raise CircuitOpenError("Waiting for a trial call to the SRI")
+
+            self._trial = True
+
+            return True
+
+    def record(self, error: bool, trial: bool = False):
+        """
+        Record the outcome of a call
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return
+
+            if self.state == self.HALF_OPEN:
+                # Only the trial call tells if the SRI recovered
+                if not trial:
+                    return
+
+                if error:
+                    self.state = self.OPEN
+                    self._opened_at = time.monotonic()
+                else:
+                    self.state = self.CLOSED
+                    self.failures = 0
+
+                return
+
+            if not error:
+                self.failures = 0
+                return
+
+            self.failures += 1
+
+            if self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class TrafficController:
+    """
+    Class for controlling the calls to the web services of an environment
+    """
+
+    def __init__(
+        self,
+        rate: float = 20.0,
+        burst: int = 20,
+        initial_concurrency: int = 8,
+        max_concurrency: int = 64,
+        target_latency: float = 2.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.limiter = AdaptiveLimiter(
+            initial=initial_concurrency,
+            maximum=max_concurrency,
+            target_latency=target_latency,
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout
+        )
+
+    @contextmanager
+    def request(self):
+        """
+        Context manager wrapping a call to the SRI
+        """
+        trial = self.breaker.check()
+        self.bucket.acquire()
+        ticket = self.limiter.acquire()
+
+        started = time.monotonic()
+        error = False
+
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.limiter.release(time.monotonic() - started, error, ticket)
+            self.breaker.record(error, trial)
+
+
+_controllers: Dict[EnvironmentEnum, TrafficController] = {}
+_lock = threading.Lock()
+
+
+def get_traffic_controller(environment: EnvironmentEnum) -> TrafficController:
+    """
+    Function to get the traffic controller of an environment
+    """
+    environment = EnvironmentEnum(environment)
+
+    with _lock:
+        controller = _controllers.get(environment)
+
+        if controller is None:
+            controller = _controllers[environment] = TrafficController()
+
+        return controller
+
+
+def configure(environment: EnvironmentEnum, **kwargs) -> TrafficController:
+    """
+    Function to replace the traffic controller of an environment, the
+    arguments are the ones of TrafficController
+    """
+    environment = EnvironmentEnum(environment)
+
+    with _lock:
+        controller = _controllers[environment] = TrafficController(**kwargs)
+
+        return controller
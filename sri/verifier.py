@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Verification of XAdES signed comprobantes
+
+Suppliers sign every document with the same certificate, so the certificates
+found in the documents are parsed, and their chain checked, once per process
+and cached by digest. Documents are verified in parallel across processes.
+
+The chain is checked regardless of the current time, each document is then
+checked against the validity period of the chain at its SigningTime, so
+comprobantes signed before the certificate expired stay valid.
+"""
+
+import base64
+import hashlib
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
+
+from lxml import etree
+from OpenSSL import crypto
+from signxml import XMLVerifier
+
+DS_NS = "http://www.w3.org/2000/09/xmldsig#"
+XADES_NS = "http://uri.etsi.org/01903/v1.3.2#"
+
+# X509_V_FLAG_NO_CHECK_TIME, not exposed by pyOpenSSL
+NO_CHECK_TIME = 0x200000
+
+# Maximum number of certificates kept per process
+CERTIFICATES_CACHE_SIZE = 1024
+
+_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+_certificates = OrderedDict()
+
+
+class VerificationResult(NamedTuple):
+    """
+    Result of the verification of a signed comprobante
+    """
+
+    index: int
+    access_key: Optional[str]
+    valid: bool
+    error: Optional[str] = None
+    subject: Optional[str] = None
+    serial_number: Optional[int] = None
+    not_after: Optional[datetime] = None
+    signing_time: Optional[str] = None
+
+
+class CachedCertificate(NamedTuple):
+    """
+    Certificate parsed from a signed document
+    """
+
+    x509: crypto.X509
+    subject: str
+    serial_number: int
+    not_after: datetime
+    error: Optional[str]
+    # Period in which every certificate of the chain is valid
+    valid_from: datetime
+    valid_until: datetime
+
+
+def _time(value: bytes) -> datetime:
+    return datetime.strptime(value.decode(), "%Y%m%d%H%M%SZ")
+
+
+def _load_ca(ca_pem_file: str) -> crypto.X509Store:
+    store = crypto.X509Store()
+    store.set_flags(NO_CHECK_TIME)
+
+    with open(ca_pem_file, "rb") as f:
+        data = f.read()
+
+    for block in data.split(b"-----END CERTIFICATE-----")[:-1]:
+        store.add_cert(
+            crypto.load_certificate(
+                crypto.FILETYPE_PEM, block + b"-----END CERTIFICATE-----"
+            )
+        )
+
+    return store
+
+
+def get_certificate(der: bytes, ca_pem_file: str = None) -> CachedCertificate:
+    """
+    Function to get a certificate by the digest of its DER encoding, the chain
+    is checked against the CA file only the first time it is seen
+    """
+    digest = (hashlib.sha256(der).digest(), ca_pem_file)
+
+    cached = _certificates.get(digest)
+
+    if cached is not None:
+        _certificates.move_to_end(digest)
+        return cached
+
+    x509 = crypto.load_certificate(crypto.FILETYPE_ASN1, der)
+    chain = [x509]
+    error = None
+
+    if ca_pem_file is not None:
+        try:
+            chain = crypto.X509StoreContext(
+                _load_ca(ca_pem_file), x509
+            ).get_verified_chain()
+        except crypto.X509StoreContextError as e:
+            error = "Invalid certificate chain: {}".format(e)
+
+    cached = CachedCertificate(
+        x509=x509,
+        subject=", ".join(
+            "{}={}".format(k.decode(), v.decode())
+            for k, v in x509.get_subject().get_components()
+        ),
+        serial_number=x509.get_serial_number(),
+        not_after=_time(x509.get_notAfter()),
+        error=error,
+        valid_from=max(_time(c.get_notBefore()) for c in chain),
+        valid_until=min(_time(c.get_notAfter()) for c in chain),
+    )
+
+    _certificates[digest] = cached
+
+    while len(_certificates) > CERTIFICATES_CACHE_SIZE:
+        _certificates.popitem(last=False)
+
+    return cached
+
+
+def _text(doc, path: str) -> Optional[str]:
+    element = doc.find(path, {"ds": DS_NS, "xades": XADES_NS})
+    return element.text.strip() if element is not None and element.text else None
+
+
+def _signing_time(value: Optional[str]) -> datetime:
+    """
+    Signing time as naive UTC, the current time when it is missing
+    """
+    if value is None:
+        return datetime.utcnow()
+
+    signing_time = datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+    if signing_time.tzinfo is not None:
+        signing_time = signing_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return signing_time
+
+
+def verify_xml(
+    xml: Union[str, bytes], ca_pem_file: str = None, index: int = 0
+) -> VerificationResult:
+    """
+    Function to verify the signature of a comprobante
+
+    Without ca_pem_file only the integrity of the document is checked against
+    the certificate it carries, with it the certificate chain is checked too.
+    """
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+
+    try:
+        doc = etree.fromstring(xml, _parser)
+    except etree.XMLSyntaxError as e:
+        return VerificationResult(
+            index=index, access_key=None, valid=False, error=str(e)
+        )
+
+    result = VerificationResult(
+        index=index,
+        access_key=_text(doc, "infoTributaria/claveAcceso"),
+        valid=False,
+        signing_time=_text(doc, ".//xades:SigningTime"),
+    )
+
+    certificate = _text(doc, ".//ds:KeyInfo/ds:X509Data/ds:X509Certificate")
+
+    if certificate is None:
+        return result._replace(error="The document has no signing certificate")
+
+    try:
+        cached = get_certificate(base64.b64decode(certificate), ca_pem_file)
+    except Exception as e:
+        return result._replace(error="Invalid certificate: {}".format(e))
+
+    result = result._replace(
+        subject=cached.subject,
+        serial_number=cached.serial_number,
+        not_after=cached.not_after,
+    )
+
+    if cached.error is not None:
+        return result._replace(error=cached.error)
+
+    if ca_pem_file is not None:
+        try:
+            signing_time = _signing_time(result.signing_time)
+        except ValueError:
+            return result._replace(error="Invalid signing time")
+
+        if not cached.valid_from <= signing_time <= cached.valid_until:
+            return result._replace(
+                error="The certificate was not valid at the signing time"
+            )
+
+    # Signers order and count references differently, all of them are checked
+    references = doc.findall(
+        ".//ds:Signature/ds:SignedInfo/ds:Reference", {"ds": DS_NS}
+    )
+
+    try:
+        verified = XMLVerifier().verify(
+            doc,
+            x509_cert=cached.x509,
+            expect_references=len(references) or 1,
+            validate_schema=False,
+        )
+    except Exception as e:
+        return result._replace(error="{}: {}".format(type(e).__name__, e))
+
+    # A single reference is returned on its own
+    if not isinstance(verified, list):
+        verified = [verified]
+
+    # The signature must cover the comprobante itself, not another element
+    if not any(
+        r.signed_xml is not None
+        and r.signed_xml.tag == doc.tag
+        and r.signed_xml.get("id") == "comprobante"
+        for r in verified
+    ):
+        return result._replace(error="The signature does not cover the comprobante")
+
+    return result._replace(valid=True)
+
+
+def _verify(args):
+    index, xml, ca_pem_file = args
+    return verify_xml(xml, ca_pem_file=ca_pem_file, index=index)
+
+
+def verify_many(
+    xmls: Iterable[Union[str, bytes]],
+    ca_pem_file: str = None,
+    workers: int = None,
+    window: int = None,
+) -> Iterator[VerificationResult]:
+    """
+    Function to verify many comprobantes in parallel, at most window documents
+    are in flight and results are returned in the input order
+    """
+    workers = workers or os.cpu_count() or 1
+    window = window or workers * 4
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for index, xml in enumerate(xmls):
+            pending.append(executor.submit(_verify, (index, xml, ca_pem_file)))
+
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming xml writer for invoices with many lines
+
+The document is written with lxml's incremental writer: each section and each
+detalle is built as a small element, written to the sink and dropped, so the
+memory used is bounded by a single line. The totals come before the detalles
+in the document, the lines are read twice: once for the totals and once to
+write them.
+
+The output is the same document as SRI.get_xml, without the whitespace
+between elements.
+"""
+
+from typing import IO, Callable, Iterable, List, Union
+
+from lxml import etree
+
+from .enum import DocumentTypeEnum
+
+
+def _line_item(line):
+    from . import LineItem
+
+    if isinstance(line, LineItem):
+        return line
+
+    return LineItem.from_trusted(**line)
+
+
+def _add(parent, tag: str, value):
+    etree.SubElement(parent, tag).text = str(value)
+
+
+class _Totals:
+    """
+    Totals of the lines, added in the same order as the properties of SRI so
+    the rounded values are identical
+    """
+
+    def __init__(self):
+        self.total_without_tax = 0
+        self.total_discount = 0
+        self.total_tax = 0
+        # [code, tax_percentage_code, additional_discount, base, value]
+        self.grouped_taxes: List[list] = []
+
+    def add(self, line):
+        self.total_without_tax += line.price_total_without_tax
+        self.total_discount += line.discount
+
+        for tax in line.taxes:
+            self.total_tax += tax.value
+
+            # Consecutive taxes with the same code are grouped, as groupby
+            if self.grouped_taxes and self.grouped_taxes[-1][:2] == [
+                tax.code,
+                tax.tax_percentage_code,
+            ]:
+                group = self.grouped_taxes[-1]
+            else:
+                group = [tax.code, tax.tax_percentage_code, 0, 0, 0]
+                self.grouped_taxes.append(group)
+
+            group[2] += tax.additional_discount
+            group[3] += tax.base
+            group[4] += tax.value
+
+
+def _info_tributaria(bill, access_key: str):
+    element = etree.Element("infoTributaria")
+    _add(element, "ambiente", bill.environment.value)
+    _add(element, "tipoEmision", bill.emission_type.value)
+    _add(element, "razonSocial", bill.billing_name)
+    _add(element, "nombreComercial", bill.company_name)
+    _add(element, "ruc", bill.company_ruc)
+    _add(element, "claveAcceso", access_key)
+    _add(element, "codDoc", "01")
+    _add(element, "estab", bill.establishment)
+    _add(element, "ptoEmi", bill.point_emission)
+    _add(element, "secuencial", bill.sequential)
+    _add(element, "dirMatriz", bill.main_address)
+
+    if bill.regimen:
+        _add(element, "contribuyenteRimpe", bill.regimen)
+
+    return element
+
+
+def _info_factura(bill, totals: _Totals):
+    element = etree.Element("infoFactura")
+    _add(element, "fechaEmision", bill.emission_date.strftime("%d/%m/%Y"))
+    _add(element, "dirEstablecimiento", bill.company_address)
+
+    if bill.company_contribuyente_especial:
+        _add(element, "contribuyenteEspecial", bill.company_contribuyente_especial)
+
+    _add(element, "obligadoContabilidad", bill.company_obligado_contabilidad)
+    _add(
+        element,
+        "tipoIdentificacionComprador",
+        bill.customer_identification_type.value,
+    )
+    _add(element, "razonSocialComprador", bill.customer_billing_name)
+    _add(element, "identificacionComprador", bill.customer_identification)
+    _add(element, "direccionComprador", bill.customer_address)
+
+    total_without_tax = round(totals.total_without_tax, 2)
+    _add(element, "totalSinImpuestos", total_without_tax)
+    _add(element, "totalDescuento", round(totals.total_discount, 2))
+
+    total_con_impuestos = etree.SubElement(element, "totalConImpuestos")
+    for group in totals.grouped_taxes:
+        code, tax_percentage_code, additional_discount, base, value = group
+        total_impuesto = etree.SubElement(total_con_impuestos, "totalImpuesto")
+        _add(total_impuesto, "codigo", code.value)
+        _add(total_impuesto, "codigoPorcentaje", tax_percentage_code.value)
+        _add(total_impuesto, "descuentoAdicional", float(round(additional_discount, 2)))
+        _add(total_impuesto, "baseImponible", float(round(base, 2)))
+        _add(total_impuesto, "valor", float(round(value, 2)))
+
+    _add(element, "propina", bill.tips)
+    _add(
+        element,
+        "importeTotal",
+        round(total_without_tax + round(totals.total_tax, 2), 2),
+    )
+    _add(element, "moneda", "DOLAR")
+
+    pagos = etree.SubElement(element, "pagos")
+    for payment in bill.payments:
+        pago = etree.SubElement(pagos, "pago")
+        _add(pago, "formaPago", payment.payment_method.value)
+        _add(pago, "total", payment.total)
+        _add(pago, "plazo", payment.terms)
+        _add(pago, "unidadTiempo", payment.unit_time.value)
+
+    return element
+
+
+def _detalle(line):
+    element = etree.Element("detalle")
+    _add(element, "codigoPrincipal", line.code)
+    _add(element, "codigoAuxiliar", line.aux_code)
+    _add(element, "descripcion", line.description)
+    _add(element, "cantidad", line.quantity)
+    _add(element, "precioUnitario", line.unit_price)
+    _add(element, "descuento", line.discount)
+    _add(element, "precioTotalSinImpuesto", line.price_total_without_tax)
+
+    impuestos = etree.SubElement(element, "impuestos")
+    for tax in line.taxes:
+        impuesto = etree.SubElement(impuestos, "impuesto")
+        _add(impuesto, "codigo", tax.code.value)
+        _add(impuesto, "codigoPorcentaje", tax.tax_percentage_code.value)
+        _add(impuesto, "tarifa", tax.tarifa)
+        _add(impuesto, "baseImponible", tax.base)
+        _add(impuesto, "valor", tax.value)
+
+    return element
+
+
+def write_xml(
+    bill,
+    sink: Union[str, IO[bytes]],
+    lines: Callable[[], Iterable] = None,
+):
+    """
+    Function to write the xml of an invoice to a file path or a binary file
+
+    lines is a function returning a new iterable of the line items, as
+    LineItem or dicts, each time it is called, e.g. a query over the lines.
+    By default the lines of the invoice are used.
+    """
+    if bill.document_type != DocumentTypeEnum.INVOICE:
+        raise ValueError(
+            "unsupported document type {}, only invoices are streamed".format(
+                bill.document_type.value
+            )
+        )
+
+    if lines is None:
+
+        def lines():
+            return bill.lines_items
+
+    totals = _Totals()
+    for line in lines():
+        totals.add(_line_item(line))
+
+    with etree.xmlfile(sink, encoding="UTF-8") as xf:
+        xf.write_declaration()
+
+        with xf.element("factura", {"id": "comprobante", "version": "1.1.0"}):
+            xf.write(_info_tributaria(bill, bill.get_access_key()))
+            xf.write(_info_factura(bill, totals))
+
+            with xf.element("detalles"):
+                for line in lines():
+                    xf.write(_detalle(_line_item(line)))
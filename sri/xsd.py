@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Local validation of comprobantes against the SRI schemas
+
+The schema of each document type is compiled once per process, a malformed
+invoice is rejected locally before it is signed and sent to the SRI.
+"""
+
+import os
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple, Union
+
+from lxml import etree
+
+from .enum import DocumentTypeEnum
+
+SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+SCHEMAS = {
+    DocumentTypeEnum.INVOICE: "factura_V1.1.0.xsd",
+}
+
+_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+def has_schema(document_type: DocumentTypeEnum) -> bool:
+    """
+    Function to check if a document type can be validated locally
+    """
+    return DocumentTypeEnum(document_type) in SCHEMAS
+
+
+@lru_cache(maxsize=None)
+def get_schema(
+    document_type: DocumentTypeEnum = DocumentTypeEnum.INVOICE,
+) -> etree.XMLSchema:
+    """
+    Function to get the compiled schema of a document type
+    """
+    document_type = DocumentTypeEnum(document_type)
+
+    if not has_schema(document_type):
+        raise ValueError(
+            "There is no schema for the document type {}".format(document_type.value)
+        )
+
+    return etree.XMLSchema(
+        etree.parse(os.path.join(SCHEMAS_DIR, SCHEMAS[document_type]))
+    )
+
+
+def validate_xml(
+    xml: Union[str, bytes],
+    document_type: DocumentTypeEnum = DocumentTypeEnum.INVOICE,
+) -> Tuple[bool, List[str]]:
+    """
+    Function to validate a comprobante against the schema of its type, returns
+    if it is valid and the errors found
+    """
+    schema = get_schema(document_type)
+
+    if isinstance(xml, str):
+        xml = xml.encode("utf-8")
+
+    try:
+        doc = etree.fromstring(xml, _parser)
+    except etree.XMLSyntaxError as e:
+        return False, [str(e)]
+
+    if schema.validate(doc):
+        return True, []
+
+    return False, [
+        "line {}: {}".format(error.line, error.message) for error in schema.error_log
+    ]
+
+
+def validate_batch(
+    xmls: Iterable[Union[str, bytes]],
+    document_type: DocumentTypeEnum = DocumentTypeEnum.INVOICE,
+) -> Iterator[Tuple[bool, List[str]]]:
+    """
+    Function to validate many comprobantes of the same type
+    """
+    for xml in xmls:
+        yield validate_xml(xml, document_type)
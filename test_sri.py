@@ -1,5 +1,5 @@
 from sri.enum import TaxCodeEnum, PercentageTaxCodeEnum, PaymentMethodEnum
-from datetime import date
+from datetime import date, datetime, timedelta
 
 
 class TestSRI:
@@ -31,6 +31,90 @@ class TestSRI:
             "customer_phone": "+59398569277",
         }
 
+    def get_line_item(self, code="0001", base=100, value=12):
+        return {
+            "code": code,
+            "aux_code": "ABC-{}".format(code),
+            "description": "Producto {} (12%)".format(code),
+            "quantity": 1,
+            "unit_price": base,
+            "discount": 0,
+            "price_total_without_tax": base,
+            "total_price": base + value,
+            "taxes": [
+                {
+                    "code": TaxCodeEnum.IVA,
+                    "tax_percentage_code": PercentageTaxCodeEnum.TWELVE,
+                    "base": base,
+                    "additional_discount": 0,
+                    "value": value,
+                },
+            ],
+        }
+
+    def get_bill(self, sequential="000000005", lines=1):
+        from sri import SRI
+
+        return SRI(
+            **{**self.get_bill_header(), "sequential": sequential},
+            lines_items=[
+                self.get_line_item(code=str(i).zfill(4)) for i in range(1, lines + 1)
+            ],
+            payments=[
+                {
+                    "payment_method": PaymentMethodEnum.CASH,
+                    "total": 112 * lines,
+                    "terms": 0,
+                    "unit_time": "dias",
+                },
+            ],
+            tips=0,
+        )
+
+    def get_certificate(self, tmp_path, password="12345678", days=(-1, 30)):
+        """
+        Create a self signed .p12 certificate
+        """
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        from cryptography.x509.oid import NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name(
+            [
+                x509.NameAttribute(NameOID.COMMON_NAME, "Rush Soft"),
+                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Test"),
+                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Rush Delivery"),
+                x509.NameAttribute(NameOID.COUNTRY_NAME, "EC"),
+            ]
+        )
+        now = datetime.utcnow()
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now + timedelta(days=days[0]))
+            .not_valid_after(now + timedelta(days=days[1]))
+            .sign(key, hashes.SHA256())
+        )
+
+        path = tmp_path / "certificate.p12"
+        path.write_bytes(
+            pkcs12.serialize_key_and_certificates(
+                b"test",
+                key,
+                cert,
+                None,
+                serialization.BestAvailableEncryption(password.encode("utf-8")),
+            )
+        )
+
+        return str(path), password
+
     def test_totals(self):
         """
         Test the SRI SDK
@@ -256,3 +340,1232 @@ class TestSRI:
         assert first.value == 14.70
 
 
+
+    def test_pipeline(self, tmp_path, monkeypatch):
+        """
+        Test the emission pipeline without calling the SRI
+        """
+
+        from sri import SRI
+        from sri.enum import InvoiceStateEnum
+        from sri.pipeline import Pipeline
+
+        def validate_xml_signed(bill, xml_signed, cache=None, xml_digest=None):
+            assert bill.get_access_key() in xml_signed
+            return True, {"estado": "RECIBIDA"}
+
+        def get_authorization(bill, cache=None):
+            response = {
+                "autorizaciones": {
+                    "autorizacion": [
+                        {"estado": "AUTORIZADO", "fechaAutorizacion": datetime.now()}
+                    ]
+                }
+            }
+            return True, response
+
+        monkeypatch.setattr(SRI, "validate_xml_signed", validate_xml_signed)
+        monkeypatch.setattr(SRI, "get_authorization", get_authorization)
+
+        certificate_file_path, password = self.get_certificate(tmp_path)
+        events = []
+
+        pipeline = Pipeline(
+            certificate_file_path=certificate_file_path,
+            password=password,
+            workers=2,
+            concurrency=2,
+            queue_size=2,
+            on_event=events.append,
+        )
+
+        bills = [self.get_bill(sequential=str(i).zfill(9)) for i in range(1, 6)]
+        results = pipeline.run(iter(bills))
+
+        assert len(results) == 5
+        assert {r.access_key for r in results} == {b.get_access_key() for b in bills}
+        assert all(r.state == InvoiceStateEnum.RENDERED for r in results)
+        assert all(r.pdf for r in results)
+        assert len(events) == 20
+
+        # Runs of the same pipeline can overlap
+        import asyncio
+
+        async def run_both():
+            return await asyncio.gather(
+                pipeline.run_async(bills[:2]), pipeline.run_async(bills[2:])
+            )
+
+        first, second = asyncio.run(run_both())
+
+        assert {r.access_key for r in first} == {b.get_access_key() for b in bills[:2]}
+        assert {r.access_key for r in second} == {b.get_access_key() for b in bills[2:]}
+
+        # A signature cached for the same document is reused by the workers
+        from sri.cache import MemoryCache, get_xml_digest
+
+        cache = MemoryCache()
+        cached = "<factura>{}</factura>".format(bills[0].get_access_key())
+        cache.set(
+            bills[0].get_access_key(),
+            xml_signed=cached,
+            xml_digest=get_xml_digest(bills[0].get_xml()),
+        )
+        cache.set(bills[1].get_access_key(), xml_signed=cached, xml_digest="x")
+
+        pipeline.cache = cache
+        results = {r.access_key: r for r in pipeline.run(bills[:2])}
+        pipeline.cache = None
+
+        assert results[bills[0].get_access_key()].xml_signed == cached
+        assert "ds:Signature" in results[bills[1].get_access_key()].xml_signed
+        assert cache.get(bills[1].get_access_key()).xml_digest == get_xml_digest(
+            bills[1].get_xml()
+        )
+
+        # A callback that raises cancels the run instead of hanging it
+        import pytest
+
+        def on_event(event):
+            raise OSError("No space left on device")
+
+        for callbacks in ({"on_event": on_event}, {"on_result": on_event}):
+            failing = Pipeline(
+                certificate_file_path=certificate_file_path,
+                password=password,
+                workers=1,
+                concurrency=1,
+                queue_size=1,
+                **callbacks,
+            )
+
+            with pytest.raises(OSError, match="No space left"):
+                asyncio.run(asyncio.wait_for(failing.run_async(iter(bills)), 30))
+
+    def test_outbox_resume(self, tmp_path, monkeypatch):
+        """
+        Test invoices that failed in flight are resumed from the outbox
+        """
+
+        from sri import SRI
+        from sri.enum import InvoiceStateEnum
+        from sri.outbox import Outbox
+        from sri.pipeline import Pipeline
+
+        def validate_timeout(bill, xml_signed, cache=None, xml_digest=None):
+            raise TimeoutError("SRI is not responding")
+
+        def validate_xml_signed(bill, xml_signed, cache=None, xml_digest=None):
+            return True, {"estado": "RECIBIDA"}
+
+        def get_authorization(bill, cache=None):
+            response = {
+                "autorizaciones": {
+                    "autorizacion": [
+                        {"estado": "AUTORIZADO", "fechaAutorizacion": datetime.now()}
+                    ]
+                }
+            }
+            return True, response
+
+        monkeypatch.setattr(SRI, "validate_xml_signed", validate_timeout)
+        monkeypatch.setattr(SRI, "get_authorization", get_authorization)
+
+        certificate_file_path, password = self.get_certificate(tmp_path)
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+
+        pipeline = Pipeline(
+            certificate_file_path=certificate_file_path,
+            password=password,
+            workers=1,
+            concurrency=2,
+            render_pdf=False,
+            outbox=outbox,
+        )
+
+        bills = [self.get_bill(sequential=str(i).zfill(9)) for i in range(1, 4)]
+
+        # Trusted bills are resumed even if they would not pass the validation
+        import json
+
+        trusted = json.loads(self.get_bill(sequential="000000004").json())
+        bills.append(SRI.from_trusted(**dict(trusted, billing_name="AB")))
+
+        results = pipeline.run(bills)
+
+        assert all(r.state == InvoiceStateEnum.FAILED for r in results)
+        outbox.close()
+
+        # Restart from the recorded state, the invoices are not signed again
+        outbox = Outbox(str(tmp_path / "outbox.db"))
+        assert outbox.counts() == {InvoiceStateEnum.SIGNED: 4}
+
+        # A bill that can not be rebuilt does not stop the others
+        outbox.record("9" * 49, InvoiceStateEnum.PENDING, bill="{")
+
+        monkeypatch.setattr(SRI, "validate_xml_signed", validate_xml_signed)
+        pipeline.outbox = outbox
+        results = pipeline.resume()
+
+        assert len(results) == 4
+        assert all(r.state == InvoiceStateEnum.AUTHORIZED for r in results)
+        assert [r.access_key for r in outbox.pending()] == ["9" * 49]
+        assert outbox.get("9" * 49).error.startswith("Invalid bill")
+
+        access_key = bills[0].get_access_key()
+        assert [state for state, _ in outbox.history(access_key)] == [
+            InvoiceStateEnum.PENDING,
+            InvoiceStateEnum.SIGNED,
+            InvoiceStateEnum.FAILED,
+            InvoiceStateEnum.RECEIVED,
+            InvoiceStateEnum.AUTHORIZED,
+        ]
+        assert outbox.get(access_key).error is None
+        outbox.close()
+
+        # Transitions are committed in batches
+        outbox = Outbox(str(tmp_path / "batch.db"), batch_size=500, flush_interval=10)
+        statements = []
+        outbox._connection.set_trace_callback(statements.append)
+
+        for i in range(3000):
+            outbox.record(str(i).zfill(49), InvoiceStateEnum.PENDING, bill="{}")
+
+        assert sum(s == "COMMIT" for s in statements) == 6
+
+        # A lookup without flush does not commit the buffered transitions
+        outbox.record("1".zfill(49), InvoiceStateEnum.SIGNED, xml_signed="<x/>")
+        assert outbox.get("1".zfill(49), flush=False).state == InvoiceStateEnum.PENDING
+        assert sum(s == "COMMIT" for s in statements) == 6
+        assert outbox.get("1".zfill(49)).state == InvoiceStateEnum.SIGNED
+        outbox.close()
+
+    def get_client(self, reception, authorization, calls):
+        """
+        Create a fake SOAP client that counts the calls to the SRI
+        """
+
+        class Service:
+            def validarComprobante(self, xml):
+                calls.append("validarComprobante")
+                return reception
+
+            def autorizacionComprobante(self, access_key):
+                calls.append("autorizacionComprobante")
+                return authorization
+
+        class Client:
+            service = Service()
+
+        return lambda wsdl: Client()
+
+    def test_result_cache(self, tmp_path, monkeypatch):
+        """
+        Test repeated calls for the same access key are served from the cache
+        """
+
+        import sri
+        from sri.cache import DiskCache, MemoryCache
+
+        authorization = {
+            "autorizaciones": {
+                "autorizacion": [
+                    {"estado": "AUTORIZADO", "fechaAutorizacion": datetime.now()}
+                ]
+            }
+        }
+        certificate_file_path, password = self.get_certificate(tmp_path)
+
+        for cache in [MemoryCache(maxsize=2), DiskCache(str(tmp_path / "cache.db"))]:
+            calls = []
+            monkeypatch.setattr(
+                sri,
+                "get_client",
+                self.get_client({"estado": "RECIBIDA"}, authorization, calls),
+            )
+            bill = self.get_bill()
+
+            for _ in range(3):
+                valid, _ = bill.validate_sri(certificate_file_path, password, cache)
+                assert valid
+
+                authorized, _ = bill.get_authorization(cache=cache)
+                assert authorized
+
+            assert calls == ["validarComprobante", "autorizacionComprobante"]
+            assert cache.get(bill.get_access_key()).xml_signed
+
+        cache = MemoryCache(maxsize=2)
+        for i in range(1, 4):
+            cache.set(str(i), xml_signed="<factura/>")
+
+        assert len(cache) == 2
+        assert cache.get("1") is None
+
+        # A returned invoice corrected under the same access key is signed again
+        returned = {
+            "estado": "DEVUELTA",
+            "comprobantes": {
+                "comprobante": [
+                    {"mensajes": {"mensaje": [{"identificador": "35"}]}},
+                ]
+            },
+        }
+
+        for cache in [MemoryCache(), DiskCache(str(tmp_path / "returned.db"))]:
+            sent = []
+
+            class Service:
+                def __init__(self, reception):
+                    self.reception = reception
+
+                def validarComprobante(self, xml):
+                    sent.append(xml.decode("utf-8"))
+                    return self.reception
+
+            for reception, name in (
+                (returned, "Jhon Doe"),
+                ({"estado": "RECIBIDA"}, "Jane Doe"),
+            ):
+                client = type("Client", (), {"service": Service(reception)})()
+                monkeypatch.setattr(sri, "get_client", lambda wsdl: client)
+                bill = self.get_bill().copy(update={"customer_billing_name": name})
+                bill.validate_sri(certificate_file_path, password, cache)
+
+            assert "Jane Doe" in sent[1]
+
+            # A signature cached for another document is not sent
+            bill = self.get_bill(sequential="000000006")
+            cache.set(bill.get_access_key(), xml_signed="<factura/>", xml_digest="x")
+            bill.validate_sri(certificate_file_path, password, cache)
+
+            assert "ds:Signature" in sent[2]
+
+        # A not authorized invoice corrected under the same access key is sent
+        # and authorized again
+        not_authorized = {
+            "autorizaciones": {"autorizacion": [{"estado": "NO AUTORIZADO"}]}
+        }
+
+        for cache in [MemoryCache(), DiskCache(str(tmp_path / "rejected.db"))]:
+            calls = []
+            results = []
+
+            for response, name in (
+                (not_authorized, "Jhon Doe"),
+                (authorization, "Jane Doe"),
+            ):
+                monkeypatch.setattr(
+                    sri,
+                    "get_client",
+                    self.get_client({"estado": "RECIBIDA"}, response, calls),
+                )
+                bill = self.get_bill().copy(update={"customer_billing_name": name})
+                valid, _ = bill.validate_sri(certificate_file_path, password, cache)
+                authorized, _ = bill.get_authorization(cache=cache)
+                results.append((valid, authorized))
+
+            assert results == [(True, False), (True, True)]
+            assert calls.count("validarComprobante") == 2
+
+    def test_access_key_registered(self, monkeypatch):
+        """
+        Test a reception returned because the access key was already
+        registered is treated as received
+        """
+
+        import sri
+
+        reception = {
+            "estado": "DEVUELTA",
+            "comprobantes": {
+                "comprobante": [
+                    {
+                        "mensajes": {
+                            "mensaje": [
+                                {
+                                    "identificador": "43",
+                                    "mensaje": "CLAVE ACCESO REGISTRADA",
+                                }
+                            ]
+                        }
+                    }
+                ]
+            },
+        }
+        monkeypatch.setattr(sri, "get_client", self.get_client(reception, None, []))
+
+        valid, response = self.get_bill().validate_xml_signed("<factura/>")
+
+        assert valid
+        assert response["estado"] == "DEVUELTA"
+
+    def test_from_trusted(self):
+        """
+        Test the trusted construction renders the same invoice as the
+        validated one
+        """
+
+        from sri import SRI
+
+        data = {
+            **self.get_bill_header(),
+            "lines_items": [self.get_line_item(), self.get_line_item(code="0002")],
+            "payments": [
+                {
+                    "payment_method": PaymentMethodEnum.CASH,
+                    "total": 224,
+                    "terms": 0,
+                    "unit_time": "dias",
+                },
+            ],
+            "tips": 0,
+        }
+
+        bill = SRI(**data)
+        trusted = SRI.from_trusted(**data)
+
+        assert isinstance(trusted, SRI)
+        assert trusted == bill
+        assert trusted.get_access_key() == bill.get_access_key()
+        assert trusted.get_xml() == bill.get_xml()
+        assert trusted.grand_total == bill.grand_total == 224
+
+    def test_bulk_sign(self, tmp_path):
+        """
+        Test signing invoices from a CSV file into a ZIP archive
+        """
+
+        import csv
+        import zipfile
+
+        from sri.bulk import ZipSink, group_rows, read_csv, sign_invoices
+        from sri.signing import load_certificate
+
+        header = {**self.get_bill_header(), "emission_date": "2023-05-10"}
+        rows = []
+        for sequential, codes in [("000000001", ["1", "2", "2"]), ("000000002", ["1"])]:
+            for code in codes:
+                rows.append(
+                    {
+                        **header,
+                        "sequential": sequential,
+                        "tips": "0",
+                        "line.code": code,
+                        "line.aux_code": "AUX",
+                        "line.description": "Producto " + code,
+                        "line.quantity": "1",
+                        "line.unit_price": "10",
+                        "line.discount": "0",
+                        "line.price_total_without_tax": "10",
+                        "line.total_price": "11.20",
+                        "tax.code": "2",
+                        "tax.tax_percentage_code": "2",
+                        "tax.base": "10",
+                        "tax.additional_discount": "0",
+                        "tax.value": "1.20",
+                        "payment.payment_method": "01",
+                        "payment.total": "22.40",
+                        "payment.terms": "0",
+                        "payment.unit_time": "dias",
+                    }
+                )
+
+        path = tmp_path / "invoices.csv"
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+        invoices = list(group_rows(read_csv(str(path))))
+
+        assert len(invoices) == 2
+        assert len(invoices[0]["lines_items"]) == 2
+        assert len(invoices[0]["lines_items"][1]["taxes"]) == 2
+        assert len(invoices[0]["payments"]) == 1
+
+        # Same product sold twice and two cash payments of the same amount
+        split = [
+            {**rows[0], "line.index": "1", "payment.index": "1"},
+            {**rows[0], "line.index": "2", "payment.index": "2"},
+        ]
+        (invoice,) = group_rows(split)
+
+        assert [len(line["taxes"]) for line in invoice["lines_items"]] == [1, 1]
+        assert "index" not in invoice["lines_items"][0]
+        assert len(invoice["payments"]) == 2
+
+        certificate = load_certificate(*self.get_certificate(tmp_path))
+
+        with ZipSink(str(tmp_path / "signed.zip")) as sink:
+            results = list(
+                sign_invoices(iter(invoices), sink, certificate, workers=2, window=1)
+            )
+
+        assert [r.index for r in results] == [0, 1]
+        assert all(r.error is None for r in results)
+
+        with zipfile.ZipFile(str(tmp_path / "signed.zip")) as archive:
+            names = archive.namelist()
+            assert names == ["{}.xml".format(r.access_key) for r in results]
+            assert b"ds:Signature" in archive.read(names[0])
+
+    def test_validate_xsd(self):
+        """
+        Test the local validation against the factura schema
+        """
+
+        from sri import SRI
+        from sri.xsd import validate_batch
+
+        bill = self.get_bill(lines=3)
+
+        assert bill.validate_xsd() == (True, [])
+
+        line = {**self.get_line_item(), "code": "X" * 30, "unit_price": 1.0000001}
+        invalid = SRI.from_trusted(**{**bill.dict(), "lines_items": [line]})
+
+        valid, errors = invalid.validate_xsd()
+
+        assert not valid
+        assert len(errors) == 2
+        assert "codigoPrincipal" in errors[0]
+        assert "precioUnitario" in errors[1]
+
+        # The invoice is rejected before it is signed and sent
+        assert invalid.validate_sri(None, None, validate_schema=True) == (
+            False,
+            errors,
+        )
+
+        results = list(validate_batch([bill.get_xml(), invalid.get_xml()]))
+        assert [valid for valid, _ in results] == [True, False]
+
+    def test_verify_signatures(self, tmp_path, monkeypatch):
+        """
+        Test the verification of signed comprobantes
+        """
+
+        from sri.signing import load_certificate
+        from sri.verifier import verify_many
+
+        certificate = load_certificate(*self.get_certificate(tmp_path))
+        bill = self.get_bill()
+        xml = bill.get_xml_signed(certificate=certificate)
+
+        ca_pem_file = tmp_path / "ca.pem"
+        ca_pem_file.write_bytes(certificate.cert)
+
+        results = list(
+            verify_many(
+                [xml, xml.replace("Jhon Doe", "Jane Doe"), "<factura/>"], workers=2
+            )
+        )
+
+        assert [r.index for r in results] == [0, 1, 2]
+        assert results[0].valid
+        assert results[0].access_key == bill.get_access_key()
+        assert "CN=Rush Soft" in results[0].subject
+        assert not results[1].valid
+        assert "Digest mismatch" in results[1].error
+        assert not results[2].valid
+
+        results = list(verify_many([xml], ca_pem_file=str(ca_pem_file), workers=1))
+        assert results[0].valid
+
+        other = tmp_path / "other"
+        other.mkdir()
+        other_ca_pem_file = other / "ca.pem"
+        other_ca_pem_file.write_bytes(
+            load_certificate(*self.get_certificate(other)).cert
+        )
+
+        results = list(verify_many([xml], ca_pem_file=str(other_ca_pem_file)))
+        assert not results[0].valid
+        assert "certificate chain" in results[0].error
+
+        # The chain is checked at the signing time, not at the current one
+        import types
+
+        import signxml.xades.xades
+
+        from sri.verifier import verify_xml
+
+        expired = tmp_path / "expired"
+        expired.mkdir()
+        certificate = load_certificate(*self.get_certificate(expired, days=(-10, -1)))
+        expired_ca_pem_file = expired / "ca.pem"
+        expired_ca_pem_file.write_bytes(certificate.cert)
+
+        signed_late = bill.get_xml_signed(certificate=certificate)
+
+        class SignedBefore(datetime):
+            @classmethod
+            def utcnow(cls):
+                return datetime.utcnow() - timedelta(days=5)
+
+        monkeypatch.setattr(
+            signxml.xades.xades,
+            "datetime",
+            types.SimpleNamespace(datetime=SignedBefore),
+        )
+        signed_before = bill.get_xml_signed(certificate=certificate)
+
+        assert verify_xml(signed_before, ca_pem_file=str(expired_ca_pem_file)).valid
+
+        result = verify_xml(signed_late, ca_pem_file=str(expired_ca_pem_file))
+        assert not result.valid
+        assert "signing time" in result.error
+
+    def test_parse_authorized(self, tmp_path):
+        """
+        Test the streaming parser of authorized comprobantes
+        """
+
+        from xml.sax.saxutils import escape
+
+        from sri import SRI
+        from sri.enum import InvoiceStateEnum
+        from sri.parser import iter_invoices, iter_totals
+
+        bills = [
+            self.get_bill(sequential=str(i).zfill(9), lines=i) for i in range(1, 4)
+        ]
+
+        path = tmp_path / "autorizaciones.xml"
+        with open(path, "w") as f:
+            f.write("<autorizaciones>")
+            for bill in bills:
+                f.write(
+                    "<autorizacion><estado>AUTORIZADO</estado>"
+                    "<numeroAutorizacion>{0}</numeroAutorizacion>"
+                    "<fechaAutorizacion>2023-05-10T10:00:00</fechaAutorizacion>"
+                    "<ambiente>PRUEBAS</ambiente>"
+                    "<comprobante>{1}</comprobante></autorizacion>".format(
+                        bill.get_access_key(), escape(bill.get_xml())
+                    )
+                )
+            f.write("</autorizaciones>")
+
+        invoices = list(iter_invoices(str(path)))
+
+        assert [i.get_access_key() for i in invoices] == [
+            b.get_access_key() for b in bills
+        ]
+        assert [i.get_xml() for i in invoices] == [b.get_xml() for b in bills]
+
+        totals = list(iter_totals(str(path)))
+
+        assert [t.grand_total for t in totals] == [112, 224, 336]
+        assert all(t.state == InvoiceStateEnum.AUTHORIZED for t in totals)
+
+        bill = SRI.from_xml(bills[0].get_xml(), validate=True)
+        assert bill.get_access_key() == bills[0].get_access_key()
+
+    def test_certificate_registry(self, tmp_path):
+        """
+        Test the certificates are loaded by RUC and kept in a bounded LRU
+        """
+
+        import os
+        import shutil
+
+        import pytest
+
+        from sri.registry import (
+            CertificateError,
+            CertificateExpiredError,
+            CertificateRegistry,
+        )
+
+        registry = CertificateRegistry(maxsize=2, check_interval=0)
+
+        for ruc in ["0100067500001", "0200067500001", "0300067500001"]:
+            path = tmp_path / ruc
+            path.mkdir()
+            registry.register(ruc, *self.get_certificate(path))
+
+        first = registry.get("0100067500001")
+        assert registry.get("0100067500001") is first
+
+        registry.get("0200067500001")
+        registry.get("0300067500001")
+
+        assert len(registry) == 2
+        assert "0100067500001" not in registry
+
+        bill = self.get_bill()
+        assert "ds:Signature" in registry.sign(bill)
+
+        # A renewed certificate file is loaded again
+        certificate_file_path = str(tmp_path / "0300067500001" / "certificate.p12")
+        warm = registry.get("0300067500001")
+        self.get_certificate(tmp_path)
+        shutil.copy(str(tmp_path / "certificate.p12"), certificate_file_path)
+        os.utime(certificate_file_path, (0, 0))
+
+        assert registry.get("0300067500001") is not warm
+
+        with pytest.raises(CertificateError):
+            registry.get("0990000000001")
+
+        expiring = CertificateRegistry(expiry_margin=timedelta(days=365))
+        expiring.register("0100067500001", *self.get_certificate(tmp_path))
+
+        with pytest.raises(CertificateExpiredError):
+            expiring.get("0100067500001")
+
+        assert [ruc for ruc, _ in expiring.expiring(timedelta(days=60))] == [
+            "0100067500001"
+        ]
+
+        # A cold RUC being resolved does not block the warm ones
+        import threading
+
+        resolving = threading.Event()
+        resolved = threading.Event()
+
+        def resolver(company_ruc):
+            resolving.set()
+            resolved.wait(10)
+            return str(tmp_path / "certificate.p12"), "12345678"
+
+        registry.resolver = resolver
+        cold = threading.Thread(target=registry.get, args=("0990000000002",))
+        cold.start()
+
+        try:
+            assert resolving.wait(10)
+
+            warm = threading.Thread(target=registry.get, args=("0300067500001",))
+            warm.start()
+            warm.join(5)
+
+            assert not warm.is_alive()
+        finally:
+            resolved.set()
+            cold.join()
+
+        assert "0990000000002" in registry
+
+    def test_traffic_control(self, monkeypatch):
+        """
+        Test the calls to the SRI are throttled and fail fast while the SRI
+        is failing
+        """
+
+        import time
+
+        import pytest
+
+        import sri
+        from sri import traffic
+        from sri.traffic import (
+            AdaptiveLimiter,
+            CircuitBreaker,
+            CircuitOpenError,
+            TokenBucket,
+        )
+
+        bucket = TokenBucket(rate=100, burst=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        assert time.monotonic() - started >= 0.04
+
+        limiter = AdaptiveLimiter(initial=8, target_latency=1)
+        for _ in range(8):
+            limiter.acquire()
+            limiter.release(0.1, False)
+        assert 8.9 < limiter.limit < 9.1
+
+        limiter.release(0.1, True, limiter.acquire())
+        assert 4.4 < limiter.limit < 4.6
+
+        # A burst of timeouts of the same window cuts the limit once
+        limiter = AdaptiveLimiter(initial=8, target_latency=1)
+        tickets = [limiter.acquire() for _ in range(8)]
+        for ticket in tickets:
+            limiter.release(5, True, ticket)
+        assert limiter.limit == 4
+
+        limiter.release(5, True, limiter.acquire())
+        assert limiter.limit == 2
+
+        monkeypatch.setattr(traffic, "_controllers", {})
+        controller = traffic.configure("1", failure_threshold=2, reset_timeout=0.05)
+
+        calls = []
+
+        class Service:
+            def validarComprobante(self, xml):
+                calls.append(xml)
+                raise ConnectionError("Service unavailable")
+
+        class Client:
+            service = Service()
+
+        monkeypatch.setattr(sri, "get_client", lambda wsdl: Client())
+
+        bill = self.get_bill()
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                bill.validate_xml_signed("<factura/>")
+
+        with pytest.raises(CircuitOpenError):
+            bill.validate_xml_signed("<factura/>")
+        assert len(calls) == 2
+
+        # A trial call is let through once the reset timeout passed
+        time.sleep(0.05)
+        with pytest.raises(ConnectionError):
+            bill.validate_xml_signed("<factura/>")
+        assert len(calls) == 3
+        assert controller.breaker.state == controller.breaker.OPEN
+
+        # A slow call started before the breaker opened does not close it,
+        # only the trial call does
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        slow = breaker.check()
+        for _ in range(2):
+            breaker.record(True, breaker.check())
+
+        breaker.record(False, slow)
+        assert breaker.state == breaker.OPEN
+
+        time.sleep(0.05)
+        trial = breaker.check()
+        breaker.record(False, slow)
+        assert breaker.state == breaker.HALF_OPEN
+
+        breaker.record(False, trial)
+        assert breaker.state == breaker.CLOSED
+
+    def test_signing_daemon(self, tmp_path):
+        """
+        Test invoices are signed by the signing daemon through the client
+        """
+
+        import os
+        import threading
+        import time
+
+        import pytest
+
+        from sri.daemon import SigningClient, SigningError, SigningServer
+
+        certificate_file_path, password = self.get_certificate(tmp_path)
+        socket_path = str(tmp_path / "sri.sock")
+
+        server = SigningServer(
+            socket_path,
+            certificate_file_path=certificate_file_path,
+            password=password,
+            workers=1,
+        )
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+
+            bills = [self.get_bill(sequential=str(i).zfill(9)) for i in range(1, 9)]
+
+            with SigningClient(socket_path) as client:
+                signed = []
+                threads = [
+                    threading.Thread(
+                        target=lambda bill: signed.append(client.get_xml_signed(bill)),
+                        args=(bill,),
+                    )
+                    for bill in bills
+                ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+                assert len(signed) == 8
+                assert all("ds:Signature" in xml for xml in signed)
+
+                with pytest.raises(SigningError):
+                    client.sign_xml("<factura")
+
+            # A request that is not an object closes only its own connection
+            import json
+            import socket
+            import struct
+
+            bad = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            bad.connect(socket_path)
+            data = json.dumps([1]).encode("utf-8")
+            bad.sendall(struct.pack(">I", len(data)) + data)
+
+            with SigningClient(socket_path, timeout=5) as client:
+                assert "ds:Signature" in client.get_xml_signed(bills[0])
+
+            assert bad.recv(1) == b""
+            bad.close()
+
+            # Idle connections are closed on stop
+            idle = SigningClient(socket_path)
+            idle.get_xml_signed(bills[0])
+        finally:
+            server.stop()
+            thread.join()
+
+        assert not os.path.exists(socket_path)
+
+    def test_write_xml(self, tmp_path):
+        """
+        Test the streamed xml is the same document as the rendered one
+        """
+
+        from io import BytesIO
+
+        from lxml import etree
+
+        from sri.xsd import validate_xml
+
+        bill = self.get_bill(lines=3)
+        bill.lines_items[1].taxes[0].tax_percentage_code = PercentageTaxCodeEnum.ZERO
+        bill.lines_items[1].taxes[0].value = 0
+
+        parser = etree.XMLParser(remove_blank_text=True)
+
+        def canonical(xml):
+            return etree.tostring(etree.fromstring(xml, parser), method="c14n")
+
+        sink = BytesIO()
+        bill.write_xml(sink)
+        xml = sink.getvalue()
+
+        assert canonical(xml) == canonical(bill.get_xml().encode("utf-8"))
+        assert validate_xml(xml, bill.document_type) == (True, [])
+
+        # Lines read twice from a source instead of the invoice
+        lines = [self.get_line_item(code=str(i).zfill(4)) for i in range(1, 4)]
+        bill = self.get_bill(lines=3)
+        streamed = bill.copy(update={"lines_items": []})
+        path = tmp_path / "factura.xml"
+        streamed.write_xml(str(path), lines=lambda: iter(lines))
+
+        assert canonical(path.read_bytes()) == canonical(bill.get_xml().encode("utf-8"))
+
+    def test_access_key_index(self, tmp_path):
+        """
+        Test the access key index finds keys by membership and by fields
+        """
+
+        import pytest
+
+        from sri.keyindex import AccessKeyIndex, decode_access_key
+
+        bill = self.get_bill()
+        key = decode_access_key(bill.get_access_key())
+
+        assert key.emission_date == bill.emission_date
+        assert key.company_ruc == bill.company_ruc
+        assert key.serie == bill.get_serie()
+        assert key.sequential == bill.sequential
+        assert key.access_key == bill.get_access_key()
+
+        with pytest.raises(ValueError):
+            decode_access_key(bill.get_access_key()[:-1] + "0")
+
+        access_keys = [
+            self.get_bill(sequential=str(i).zfill(9)).get_access_key()
+            for i in range(20, 0, -1)
+        ]
+        path = str(tmp_path / "keys.idx")
+
+        with AccessKeyIndex(path) as index:
+            assert index.update(access_keys[:10]) == 10
+            index.flush()
+            assert index.update(access_keys) == 10
+            assert not index.add(access_keys[0])
+
+            assert access_keys[15] in index
+            assert self.get_bill(sequential="000000021").get_access_key() not in index
+
+        with AccessKeyIndex(path) as index:
+            assert len(index) == 20
+            assert all(access_key in index for access_key in access_keys)
+
+            found = list(
+                index.find(
+                    bill.company_ruc,
+                    document_type="01",
+                    establishment="001",
+                    point_emission="001",
+                    sequential_from="000000005",
+                    sequential_to="000000008",
+                )
+            )
+            assert [k.sequential for k in found] == [
+                "000000005",
+                "000000006",
+                "000000007",
+                "000000008",
+            ]
+            assert len(list(index.find(bill.company_ruc, date_to=date.today()))) == 20
+            assert index.get(bill.company_ruc, "01", "001", "001", "000000021") is None
+
+    def test_cli(self, tmp_path, monkeypatch, capsys):
+        """
+        Test the command line tool renders, submits and resumes a run
+        """
+
+        import os
+
+        from sri import SRI
+        from sri.cli import main
+
+        def validate_timeout(bill, xml_signed, cache=None, xml_digest=None):
+            raise TimeoutError("SRI is not responding")
+
+        def validate_xml_signed(bill, xml_signed, cache=None, xml_digest=None):
+            return True, {"estado": "RECIBIDA"}
+
+        def get_authorization(bill, cache=None):
+            response = {
+                "autorizaciones": {
+                    "autorizacion": [
+                        {"estado": "AUTORIZADO", "fechaAutorizacion": datetime.now()}
+                    ]
+                }
+            }
+            return True, response
+
+        invoices = tmp_path / "invoices.jsonl"
+        invoices.write_text(
+            "\n".join(
+                self.get_bill(sequential=str(i).zfill(9)).json() for i in range(1, 4)
+            )
+        )
+        certificate_file_path, password = self.get_certificate(tmp_path)
+        options = [
+            str(invoices),
+            "-o",
+            str(tmp_path / "out"),
+            "--certificate",
+            certificate_file_path,
+            "--password",
+            password,
+            "--workers",
+            "1",
+            "--outbox",
+            str(tmp_path / "outbox.db"),
+            "--poll-interval",
+            "0",
+            "-q",
+        ]
+
+        assert main(["render", str(invoices), "-o", str(tmp_path / "xml"), "-q"]) == 0
+        assert len(os.listdir(str(tmp_path / "xml"))) == 3
+
+        monkeypatch.setattr(SRI, "validate_xml_signed", validate_timeout)
+        assert main(["submit"] + options) == 1
+
+        # The invoices are resumed from the outbox without being signed again
+        monkeypatch.setattr(SRI, "validate_xml_signed", validate_xml_signed)
+        monkeypatch.setattr(SRI, "get_authorization", get_authorization)
+        capsys.readouterr()
+        assert main(["authorize"] + options) == 0
+
+        summary = capsys.readouterr().out
+        assert "3 invoices" in summary
+        assert "AUTORIZADO" in summary
+        assert "\nsign " not in summary
+        assert "authorize" in summary
+
+        assert main(["authorize"] + options) == 0
+        assert "SKIPPED (AUTORIZADO)" in capsys.readouterr().out
+
+    def test_metrics(self, monkeypatch):
+        """
+        Test the calls to the SRI are measured and exported for Prometheus
+        """
+
+        from urllib.request import urlopen
+
+        import sri
+        from sri import metrics
+
+        reception = {"estado": "RECIBIDA", "comprobantes": None}
+        authorization = {
+            "autorizaciones": {
+                "autorizacion": [
+                    {"estado": "AUTORIZADO", "fechaAutorizacion": datetime.now()}
+                ]
+            }
+        }
+        monkeypatch.setattr(
+            sri, "get_client", self.get_client(reception, authorization, [])
+        )
+
+        received = metrics.RECEPTION_SECONDS.get(state="RECIBIDA")
+        authorized = metrics.AUTHORIZATION_SECONDS.get(state="AUTORIZADO")
+
+        bill = self.get_bill(sequential="000000040")
+        bill.validate_xml_signed("<factura/>")
+        assert metrics.RECEPTION_SECONDS.get(state="RECIBIDA") == received + 1
+        assert metrics.PENDING_AUTHORIZATIONS.get() >= 1
+
+        pending = metrics.PENDING_AUTHORIZATIONS.get()
+        bill.get_authorization()
+        assert metrics.AUTHORIZATION_SECONDS.get(state="AUTORIZADO") == authorized + 1
+        assert metrics.PENDING_AUTHORIZATIONS.get() == pending - 1
+
+        # Comprobantes whose authorization is never polled here are dropped
+        monkeypatch.setattr(metrics, "_pending", metrics.OrderedDict())
+        monkeypatch.setattr(metrics, "PENDING_MAXSIZE", 3)
+        for i in range(5):
+            metrics.set_pending(str(i), True)
+        assert metrics.PENDING_AUTHORIZATIONS.get() == 3
+
+        monkeypatch.setattr(metrics, "PENDING_TTL", 0)
+        metrics.set_pending("5", True)
+        assert metrics.PENDING_AUTHORIZATIONS.get() <= 1
+
+        registry = metrics.Registry()
+        histogram = metrics.Histogram(
+            "test_seconds", "Test", ["state"], buckets=[0.1, 1], registry=registry
+        )
+        histogram.observe(0.05, state='a"b')
+        histogram.observe(0.5, state='a"b')
+        metrics.Counter("test_total", "Test", registry=registry).inc(3)
+
+        assert registry.exposition() == (
+            "# HELP test_seconds Test\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{state="a\\"b",le="0.1"} 1\n'
+            'test_seconds_bucket{state="a\\"b",le="1"} 2\n'
+            'test_seconds_bucket{state="a\\"b",le="+Inf"} 2\n'
+            'test_seconds_sum{state="a\\"b"} 0.55\n'
+            'test_seconds_count{state="a\\"b"} 2\n'
+            "# HELP test_total Test\n"
+            "# TYPE test_total counter\n"
+            "test_total 3\n"
+        )
+
+        server = metrics.start_http_server(0)
+        try:
+            with urlopen(
+                "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            ) as response:
+                body = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+
+        assert 'sri_reception_seconds_count{state="RECIBIDA"}' in body
+        assert "# TYPE sri_pending_authorizations gauge" in body
+
+    def test_document_types(self, tmp_path, monkeypatch):
+        """
+        Test credit and debit notes are rendered and signed like invoices
+        """
+
+        import os
+        from io import BytesIO
+
+        import pytest
+        from lxml import etree
+        from pydantic import ValidationError
+
+        from sri import SRI
+        from sri.verifier import verify_xml
+
+        invoice = self.get_bill()
+        data = {
+            **invoice.dict(),
+            "document_type": "04",
+            "modified_document_type": "01",
+            "modified_document_number": "001-001-000000005",
+            "modified_document_date": invoice.emission_date,
+            "reason": "Devolucion",
+        }
+
+        credit_note = SRI(**data)
+        debit_note = SRI(**{**data, "document_type": "05", "reason": None})
+
+        for bill, root in ((credit_note, "notaCredito"), (debit_note, "notaDebito")):
+            doc = etree.fromstring(bill.get_xml().encode("utf-8"))
+
+            assert doc.tag == root
+            assert doc.findtext("infoTributaria/codDoc") == bill.document_type.value
+            assert bill.get_access_key()[8:10] == bill.document_type.value
+            assert doc.findtext(".//numDocModificado") == "001-001-000000005"
+
+        doc = etree.fromstring(credit_note.get_xml().encode("utf-8"))
+        assert doc.findtext("infoNotaCredito/valorModificacion") == "112.0"
+        assert doc.findtext("infoNotaCredito/motivo") == "Devolucion"
+
+        # The invoice is rendered by the same engine
+        assert etree.fromstring(invoice.get_xml().encode("utf-8")).tag == "factura"
+
+        # A credit note must reference the modified comprobante and its reason
+        with pytest.raises(ValidationError):
+            SRI(**{**data, "reason": None})
+
+        guide = SRI(**{**invoice.dict(), "document_type": "06"})
+
+        with pytest.raises(ValueError, match="unsupported document type"):
+            guide.get_xml()
+
+        with pytest.raises(ValueError, match="unsupported document type"):
+            credit_note.write_xml(str(tmp_path / "nota.xml"))
+
+        # Only the xml is refused, the RIDE falls back to a title
+        assert guide.get_pdf(datetime.now())
+
+        certificate_file_path, password = self.get_certificate(tmp_path)
+        signed = credit_note.get_xml_signed(certificate_file_path, password)
+
+        assert verify_xml(signed).valid
+
+        # Credit notes are read back, debit notes only have their totals
+        from sri.parser import iter_totals
+
+        assert SRI.from_xml(credit_note.get_xml()).get_xml() == credit_note.get_xml()
+
+        with pytest.raises(ValueError, match="Debit notes"):
+            SRI.from_xml(debit_note.get_xml())
+
+        with pytest.raises(ValueError, match="Unsupported comprobante"):
+            SRI.from_xml("<guiaRemision/>")
+
+        xml = "<comprobantes>{}{}{}</comprobantes>".format(
+            *(
+                b.get_xml().replace('<?xml version="1.0" encoding="UTF-8"?>', "")
+                for b in (invoice, credit_note, debit_note)
+            )
+        )
+        totals = list(iter_totals(BytesIO(xml.encode("utf-8"))))
+
+        assert [t.document_type for t in totals] == ["01", "04", "05"]
+        assert [t.grand_total for t in totals] == [112, 112, 112]
+
+        # Notes have no local schema, they are sent to the SRI
+        import sri
+
+        calls = []
+        monkeypatch.setattr(
+            sri, "get_client", self.get_client({"estado": "RECIBIDA"}, None, calls)
+        )
+        assert credit_note.validate_sri(
+            certificate_file_path, password, validate_schema=True
+        ) == (True, {"estado": "RECIBIDA"})
+        assert calls == ["validarComprobante"]
+
+        # The command line renders every document type
+        from sri.cli import main
+
+        notes = tmp_path / "notas.jsonl"
+        notes.write_text("\n".join(b.json() for b in (credit_note, debit_note)))
+
+        assert main(["render", str(notes), "-o", str(tmp_path / "xml"), "-q"]) == 0
+        assert len(os.listdir(str(tmp_path / "xml"))) == 2